@@ -2,7 +2,7 @@
 #
 # imports everything you want to make a game
 
-from textadv.core.rulesystem import NotHandled, AbortAction, ActionHandled, MultipleResults, FinishWith
+from textadv.core.rulesystem import NotHandled, NOT_HANDLED, AbortAction, ActionHandled, MultipleResults, FinishWith
 from textadv.gamesystem.utilities import *
 from textadv.gamesystem.relations import *
 from textadv.gamesystem.gamecontexts import ActorContext, execute_context
@@ -4,9 +4,12 @@
 #
 # What's here:
 # Exceptions: NotHandled, AbortAction, ActionHandled, MultipleResults, FinishWith, RestartWith
+# Markers: NOT_HANDLED
 # Classes: ActionTable, PropertyTable, EventTable
+# Profiling: RuleProfiler, start_profiling, stop_profiling, get_profiler
 
-from patterns import NoMatchException, AbstractPattern, BasicPattern, VarPattern
+import timeit
+from patterns import NoMatchException, AbstractPattern, BasicPattern, VarPattern, PatternRequires
 
 class AbortAction(Exception) :
     """Raised when a handler wants to stop the action from being
@@ -15,52 +18,227 @@ class AbortAction(Exception) :
     def __init__(self, *args, **kwargs) :
         self.args = args
         self.kwargs = kwargs
-class ActionHandled(Exception) :
+class HandlerSignal(Exception) :
+    """The base class of the exceptions a handler uses to tell the
+    table running it what to do with its result.  Instead of raising
+    one of these, a handler may return it, which is cheaper since
+    nothing needs to be unwound.  For instance, "return
+    ActionHandled(x)" is the same as "raise ActionHandled(x)"."""
+    pass
+
+class ActionHandled(HandlerSignal) :
     """Raised when a handler wants to stop the action from being
     handled anymore.  Used to signal that it's ok we're done."""
     pass
 
-class MultipleResults(Exception) :
+class MultipleResults(HandlerSignal) :
     """Raised when a handler has multiple values to return (for
     ActionTables with accumulators)."""
     pass
 
-class FinishWith(Exception) :
+class FinishWith(HandlerSignal) :
     """Raised when a handler wants to return multiple values and also
     use the values accumulated so far (ActionHandled ignores the
     accumulated values)."""
     pass
 
-class RestartWith(Exception) :
+class RestartWith(HandlerSignal) :
     """Raised when a handler wants to return multiple values and also
     overwrite the values accumulated so far (ActionHandled ignores the
     accumulated values)."""
     pass
 
-class NotHandled(Exception) :
+class NotHandled(HandlerSignal) :
     """Raised when an event wants to prematurely exit.  Used to signal
     skipping without affecting anything."""
     pass
 
+# A handler may return this instead of raising NotHandled.
+NOT_HANDLED = NotHandled()
+
+# The types of results which the tables treat as signals rather than
+# values.
+_SIGNAL_TYPES = frozenset([ActionHandled, MultipleResults, FinishWith, RestartWith, NotHandled])
+
+###
+### Profiling
+###
+
+class ProfileEntry(object) :
+    """The statistics for one handler (and pattern) in a table.
+    calls is how many times the handler was called, attempts is how
+    many times its pattern was matched against, hits is how many times
+    it gave a result other than NotHandled, and time is the seconds
+    spent in it, including the handlers it called in turn."""
+    def __init__(self, kind, handler, pattern) :
+        self.kind = kind
+        self.handler = handler
+        self.pattern = pattern
+        self.calls = 0
+        self.attempts = 0
+        self.hits = 0
+        self.time = 0.0
+    def to_dict(self) :
+        return {"kind" : self.kind, "handler" : self.handler, "pattern" : self.pattern,
+                "calls" : self.calls, "attempts" : self.attempts, "hits" : self.hits,
+                "time" : self.time}
+
+def _handler_name(f) :
+    return "%s.%s" % (getattr(f, "__module__", None), getattr(f, "__name__", repr(f)))
+
+class RuleProfiler(object) :
+    """Collects a ProfileEntry for each handler run by the
+    PropertyTables, ActivityTables, and RuleTables while it is the
+    active profiler (see start_profiling)."""
+    def __init__(self) :
+        self.entries = dict() # (kind, id(handler), id(pattern)) -> ProfileEntry
+        self.timer = timeit.default_timer
+    def entry(self, kind, f, pattern) :
+        key = (kind, id(f), id(pattern))
+        try :
+            return self.entries[key]
+        except KeyError :
+            if f is None :
+                name = "(value)"
+            else :
+                name = _handler_name(f)
+            e = self.entries[key] = ProfileEntry(kind, name, None if pattern is None else repr(pattern))
+            return e
+    def call(self, e, f, args, kwargs) :
+        """Calls f for the entry, returning either its result or the
+        HandlerSignal it raised."""
+        e.calls += 1
+        start = self.timer()
+        try :
+            try :
+                result = f(*args, **kwargs)
+            except HandlerSignal as ix :
+                result = ix
+        finally :
+            e.time += self.timer() - start
+        if type(result) is not NotHandled :
+            e.hits += 1
+        return result
+    def results(self) :
+        """Returns the entries as dictionaries, most time first."""
+        out = [e.to_dict() for e in self.entries.itervalues()]
+        out.sort(key=lambda d : (-d["time"], -d["attempts"]))
+        return out
+    def to_json(self) :
+        import json
+        return json.dumps(self.results(), indent=1)
+    def dump(self, filename) :
+        """Writes the results to the file as JSON."""
+        with open(filename, "w") as f :
+            f.write(self.to_json())
+
+# The active RuleProfiler, if any.  The tables check this once per
+# notify (or get_property) so that profiling costs almost nothing
+# when it is off.
+_profiler = None
+
+def start_profiling() :
+    """Starts profiling all tables with a new RuleProfiler, which is
+    returned."""
+    global _profiler
+    _profiler = RuleProfiler()
+    return _profiler
+
+def stop_profiling() :
+    """Stops profiling.  Returns the profiler which was active."""
+    global _profiler
+    profiler, _profiler = _profiler, None
+    return profiler
+
+def get_profiler() :
+    """Returns the active RuleProfiler, or None."""
+    return _profiler
+
 def handler_requires(b) :
     """A predicate which simply raises NotHandled if the argument is
     false."""
     if not b :
         raise NotHandled()
 
+def kind_guard(key) :
+    """If the key is guarded only by a kind, like X <= IsA(X,
+    "door"), returns the index of the guarded argument and the kind.
+    Otherwise returns None.  The guard is a kind test when the support
+    is a relation marked instance_of (whose property is then assumed
+    to ask whether the object is in the world's extent of the
+    kind)."""
+    if type(key) is not PatternRequires :
+        return None
+    support = key.support
+    if not getattr(type(support), "instance_of", False) :
+        return None
+    var, kind = support.args
+    if type(var) is not VarPattern or not isinstance(kind, basestring) :
+        return None
+    for i, arg in enumerate(getattr(key.pattern, "args", ())) :
+        if type(arg) is VarPattern and arg.varName == var.varName :
+            return (i, kind)
+    return None
+
 class PropertyTable(object) :
     """Represents a table of properties whose keys are patterns (for
     instance Description("myobj")).  Executes in reverse definition
-    order, and the first successful result is returned."""
+    order, and the first successful result is returned.
+
+    Entries guarded only by a kind (see kind_guard) are sorted into
+    buckets: for each combination of kinds of the guarded arguments,
+    the bucket has the entries which could apply, in order, with the
+    kind guards already taken care of."""
     def __init__(self) :
         self.properties = dict() # dict for some optimization
+        self.guarded_args = dict() # property -> indices of arguments with kind guards
+        self.buckets = dict() # (property, kinds of guarded arguments) -> entries
     def set_property(self, item, value, call=False) :
         if not isinstance(item, AbstractPattern) :
             raise Exception("The only properties may be AbstractPatterns.")
-        if not self.properties.has_key(item.file_under()) :
-            self.properties[item.file_under()] = [(item, value, call)]
+        prop = item.file_under()
+        if not self.properties.has_key(prop) :
+            self.properties[prop] = [(item, value, call)]
         else :
-            self.properties[item.file_under()].insert(0, (item, value, call))
+            self.properties[prop].insert(0, (item, value, call))
+        guard = kind_guard(item)
+        if guard is not None :
+            indices = self.guarded_args.get(prop, ())
+            if guard[0] not in indices :
+                self.guarded_args[prop] = tuple(sorted(indices + (guard[0],)))
+        if self.buckets :
+            self.buckets = dict()
+    def only_values(self, prop) :
+        """Whether every entry for the property is a value (not a
+        handler) given either for particular arguments or guarded only
+        by a kind.  The results for such a property can only change
+        when it is set or when the kinds of objects change."""
+        for key,value,call in self.properties.get(prop, ()) :
+            if call or not (isinstance(key, BasicPattern) or kind_guard(key) is not None) :
+                return False
+        return True
+    def __bucket(self, prop, item, world) :
+        """Gets the entries to try for the item, or None if the item
+        can't be sorted into a bucket."""
+        indices = self.guarded_args.get(prop)
+        if indices is None or world is None :
+            return None
+        try :
+            kinds = tuple([world.kinds_of(item.args[i]) for i in indices])
+            return self.buckets[(prop, kinds)]
+        except TypeError : # an argument which can't be an object
+            return None
+        except KeyError :
+            pass
+        bucket = []
+        for key,value,call in self.properties[prop] :
+            guard = kind_guard(key)
+            if guard is None :
+                bucket.append((key, value, call))
+            elif guard[1] in kinds[indices.index(guard[0])] :
+                bucket.append((key.pattern, value, call))
+        self.buckets[(prop, kinds)] = bucket
+        return bucket
     def __setitem__(self, item, value) :
         self.set_property(item, value)
     def get_property(self, item, data) :
@@ -68,13 +246,23 @@ class PropertyTable(object) :
             raise Exception("The only properties may be BasicPatterns.")
         if not self.properties.has_key(item.file_under()) :
             raise KeyError(item)
-        for key,value,call in self.properties[item.file_under()] :
+        if _profiler is not None :
+            return self.__profiled_get_property(item, data, _profiler)
+        prop = item.file_under()
+        entries = self.__bucket(prop, item, data.get("world"))
+        if entries is None :
+            entries = self.properties[prop]
+        for key,value,call in entries :
             try :
                 matches = key.match(item, data=data)
                 if call :
                     for k,v in data.iteritems() :
                         matches[k] = v
-                    return value(**matches)
+                    result = value(**matches)
+                    if not isinstance(result, HandlerSignal) :
+                        return result
+                    elif type(result) is not NotHandled :
+                        raise result
                 else :
                     return value
             except NoMatchException : # on these exceptions, just try next one
@@ -82,6 +270,99 @@ class PropertyTable(object) :
             except NotHandled :
                 pass
         raise KeyError(item)
+    def get_properties(self, items, data) :
+        """Like get_property for each of the items (which should all be
+        filed under the same property), giving the list of results.
+        The entries are tried for all of the items together, and a
+        guard (the support of a PatternRequires) which comes up for
+        more than one item or entry is only tested once."""
+        if _profiler is not None :
+            return [self.get_property(item, data) for item in items]
+        results = [None] * len(items)
+        guards = dict() # expanded support -> whether it holds
+        world = data.get("world")
+        # the items which have the same entries to try (see __bucket)
+        groups = dict()
+        if items :
+            prop = items[0].file_under()
+            all_entries = self.properties.get(prop, ())
+            for i, item in enumerate(items) :
+                entries = self.__bucket(prop, item, world)
+                if entries is None :
+                    entries = all_entries
+                groups.setdefault(id(entries), (entries, []))[1].append(i)
+        for entries, pending in groups.itervalues() :
+            pending = self.__get_group(entries, items, pending, results, guards, data, world)
+            if pending :
+                raise KeyError(items[pending[0]])
+        return results
+    def __get_group(self, entries, items, pending, results, guards, data, world) :
+        """Tries the entries for the pending items in order, putting
+        what they give into results.  Returns the items which no entry
+        handled."""
+        for key,value,call in entries :
+            if not pending :
+                break
+            still_pending = []
+            requires = type(key) is PatternRequires
+            for i in pending :
+                item = items[i]
+                try :
+                    if requires :
+                        matches = key.pattern.match(item, data=data)
+                        try :
+                            support = key.support.expand_pattern(matches, data=data)
+                        except KeyError :
+                            raise NoMatchException(key, key.support)
+                        try :
+                            holds = guards[support]
+                        except KeyError :
+                            holds = guards[support] = support.test(world)
+                        if not holds :
+                            raise NoMatchException(key, key.support)
+                    else :
+                        matches = key.match(item, data=data)
+                    if call :
+                        for k,v in data.iteritems() :
+                            matches[k] = v
+                        result = value(**matches)
+                        if not isinstance(result, HandlerSignal) :
+                            results[i] = result
+                        elif type(result) is NotHandled :
+                            still_pending.append(i)
+                        else :
+                            raise result
+                    else :
+                        results[i] = value
+                except NoMatchException :
+                    still_pending.append(i)
+                except NotHandled :
+                    still_pending.append(i)
+            pending = still_pending
+        return pending
+    def __profiled_get_property(self, item, data, profiler) :
+        """get_property, but keeping statistics in the profiler."""
+        for key,value,call in self.properties[item.file_under()] :
+            e = profiler.entry("property" if call else "value", value if call else None, key)
+            e.attempts += 1
+            try :
+                matches = key.match(item, data=data)
+                if call :
+                    for k,v in data.iteritems() :
+                        matches[k] = v
+                    result = profiler.call(e, value, (), matches)
+            except NoMatchException :
+                continue
+            if call :
+                if type(result) is NotHandled :
+                    continue
+                elif isinstance(result, HandlerSignal) :
+                    raise result
+                return result
+            else :
+                e.hits += 1
+                return value
+        raise KeyError(item)
     def handler(self, item) :
         """This is a decorator to add a function which should be
         called when getting a property."""
@@ -106,6 +387,8 @@ class PropertyTable(object) :
         for t,table in self.properties.iteritems() :
             newdict[t] = list(table)
         newtable.properties = newdict
+        newtable.guarded_args = self.guarded_args.copy()
+        newtable.buckets = self.buckets.copy()
         return newtable
     def make_documentation(self, escape, heading_level=1) :
         import inspect
@@ -154,34 +437,59 @@ class ActivityTable(object) :
         self.disabled = []
         self.current_disabled = None
         self.last_current_disabled = []
+        # compiled form of the table, made by compile
+        self.handlers = None
+        self.disabled_set = frozenset()
+        # counts the changes to the table, for caches of its results
+        self.version = 0
+    def compile(self) :
+        """Precomputes the tuple of (handler, wants_table) pairs and
+        the set of disabled handlers which notify uses.  This is done
+        automatically whenever the table has changed."""
+        self.handlers = tuple(zip(self.actions, self.wants_table))
+        self.disabled_set = frozenset(self.disabled)
+        return self.handlers
     def notify(self, args, data, disable=None) :
-        self.__push_current_disabled(disable or [])
-        acc = []
-        for f, wt in zip(self.actions, self.wants_table) :
-            if f in self.current_disabled :
-                continue
-            try :
-                if wt :
-                    acc.append(f(self, *args, **data))
-                else :
-                    acc.append(f(*args, **data))
-            except NotHandled :
-                pass
-            except ActionHandled as ix :
-                self.__pop_current_disabled()
-                return self.accumulator(ix.args)
-            except MultipleResults as ix :
-                acc.extend(ix.args)
-            except RestartWith as ix :
-                acc = list(ix.args)
-            except FinishWith as ix :
-                self.__pop_current_disabled()
-                return self.accumulator(acc + ix.args)
-            except :
-                self.__pop_current_disabled()
-                raise
-        self.__pop_current_disabled()
-        return self.accumulator(acc)
+        handlers = self.handlers
+        if handlers is None :
+            handlers = self.compile()
+        self.last_current_disabled.append(self.current_disabled)
+        if disable :
+            self.current_disabled = self.disabled_set.union(disable)
+        else :
+            self.current_disabled = self.disabled_set
+        profiler = _profiler
+        try :
+            acc = []
+            for f, wt in handlers :
+                if f in self.current_disabled :
+                    continue
+                try :
+                    if profiler is not None :
+                        e = profiler.entry("activity", f, None)
+                        e.attempts += 1
+                        result = profiler.call(e, f, (self,)+tuple(args) if wt else args, data)
+                    elif wt :
+                        result = f(self, *args, **data)
+                    else :
+                        result = f(*args, **data)
+                except HandlerSignal as ix :
+                    result = ix
+                if type(result) not in _SIGNAL_TYPES :
+                    acc.append(result)
+                    continue
+                signal = type(result)
+                if signal is ActionHandled :
+                    return self.accumulator(result.args)
+                elif signal is MultipleResults :
+                    acc.extend(result.args)
+                elif signal is RestartWith :
+                    acc = list(result.args)
+                elif signal is FinishWith :
+                    return self.accumulator(acc + list(result.args))
+            return self.accumulator(acc)
+        finally :
+            self.current_disabled = self.last_current_disabled.pop()
     def add_handler(self, f, insert_first=None, insert_last=None, insert_before=None, insert_after=None,
                     wants_table=None) :
         """A function (which can be used as a decorator) which adds
@@ -212,6 +520,8 @@ class ActivityTable(object) :
             i = self.actions.index(insert_before)
             self.actions.insert(i+1, f)
             self.wants_table.insert(i+1, wants_table)
+        self.handlers = None
+        self.version += 1
         return f
     def disable(self, f=None) :
         """This disables a function in the activity table
@@ -222,6 +532,8 @@ class ActivityTable(object) :
         if f :
             if f in self.actions :
                 self.disabled.append(f)
+                self.handlers = None
+                self.version += 1
             else :
                 raise Exception("The given f=%r is not in the table." % f)
         else :
@@ -231,7 +543,7 @@ class ActivityTable(object) :
         of the table."""
         if f :
             if f in self.actions :
-                self.current_disabled.append(f)
+                self.current_disabled = self.current_disabled.union([f])
             else :
                 raise Exception("The given f=%r is not in the table." % f)
         else :
@@ -242,14 +554,9 @@ class ActivityTable(object) :
         previously disabled."""
         if f :
             if f in self.current_disabled :
-                self.current_disabled.remove(f)
+                self.current_disabled = self.current_disabled.difference([f])
         else :
             raise Exception("No f given to temporarily disable.")
-    def __push_current_disabled(self, to_disable) :
-        self.last_current_disabled.append(self.current_disabled)
-        self.current_disabled = to_disable+self.disabled
-    def __pop_current_disabled(self) :
-        self.current_disabled = self.last_current_disabled.pop()
     def copy(self) :
         """Returns a copy which behaves like before, except the
         activity table has been suitably remade.  Values are stored in
@@ -352,44 +659,55 @@ class RuleTable(object) :
                 actions.insert(i+1, (pattern, f, wants_event, wants_table))
     def notify(self, event, data, pattern_data=None, disable=None) :
         self.__push_current_disabled(disable or [])
-        accum = []
-        if not pattern_data :
-            pattern_data = data
-        for (pattern, f, wants_event, wants_table) in self.actions.get(event.file_under(), self.actions["default"]) :
-            if f in self.current_disabled :
-                continue
-            try :
-                matches = pattern.match(event, data=pattern_data)
+        profiler = _profiler
+        try :
+            accum = []
+            if not pattern_data :
+                pattern_data = data
+            for (pattern, f, wants_event, wants_table) in self.actions.get(event.file_under(), self.actions["default"]) :
+                if f in self.current_disabled :
+                    continue
+                if profiler is not None :
+                    e = profiler.entry("rule", f, pattern)
+                    e.attempts += 1
+                try :
+                    matches = pattern.match(event, data=pattern_data)
+                except NoMatchException :
+                    continue
                 for k,v in data.iteritems() :
                     matches[k] = v
-                if wants_event :
-                    if wants_table :
-                        accum.append(f(event, self, **matches))
-                    else :
-                        accum.append(f(event, **matches))
-                else :
-                    if wants_table :
-                        accum.append(f(self, **matches))
+                try :
+                    if profiler is not None :
+                        result = profiler.call(e, f, ((event,) if wants_event else ()) + ((self,) if wants_table else ()), matches)
+                    elif wants_event :
+                        if wants_table :
+                            result = f(event, self, **matches)
+                        else :
+                            result = f(event, **matches)
                     else :
-                        accum.append(f(**matches))
-            except NoMatchException :
-                pass
-            except NotHandled :
-                pass
-            except ActionHandled as ix :
-                self.__pop_current_disabled()
-                return self.accumulator(ix.args)
-            except MultipleResults as ix :
-                acc.extend(ix.args)
-            except RestartWith as ix :
-                acc = list(ix.args)
-            except FinishWith as ix :
-                self.__pop_current_disabled()
-                return self.accumulator(acc + ix.args)
-            except :
-                self.__pop_current_disabled()
-                raise
-        return self.accumulator(accum)
+                        if wants_table :
+                            result = f(self, **matches)
+                        else :
+                            result = f(**matches)
+                except NoMatchException :
+                    continue
+                except HandlerSignal as ix :
+                    result = ix
+                if type(result) not in _SIGNAL_TYPES :
+                    accum.append(result)
+                    continue
+                signal = type(result)
+                if signal is ActionHandled :
+                    return self.accumulator(result.args)
+                elif signal is MultipleResults :
+                    accum.extend(result.args)
+                elif signal is RestartWith :
+                    accum = list(result.args)
+                elif signal is FinishWith :
+                    return self.accumulator(accum + list(result.args))
+            return self.accumulator(accum)
+        finally :
+            self.__pop_current_disabled()
     def __push_current_disabled(self, to_disable) :
         self.last_current_disabled.append(self.current_disabled)
         self.current_disabled = to_disable+self.disabled
@@ -486,11 +804,18 @@ class RuleTable(object) :
 ##
 
 class ActivityHelperObject(object) :
+    """Turns obj.activity.name(...) into
+    handler.call_activity("name", ...).  The caller for each name is
+    made once and then kept as an attribute."""
     def __init__(self, handler) :
         self.__handler__ = handler
     def __getattr__(self, name) :
+        if name.startswith("__") :
+            raise AttributeError(name)
+        handler = self.__handler__
         def _caller(*args, **kwargs) :
-            return self.__handler__.call_activity(name, *args, **kwargs)
+            return handler.call_activity(name, *args, **kwargs)
+        self.__dict__[name] = _caller
         return _caller
 
 class RuleHelperObject(object) :
@@ -531,10 +856,10 @@ class TestEvents(unittest.TestCase) :
             self.args = [event]
 
     def test_table(self) :
-        table = ActionTable()
-        when = makeEventPatternDecorator(table)
+        table = RuleTable()
+        when = make_rule_decorator(table)
         test = []
-        x = PVar("x")
+        x = VarPattern("x")
         data = dict()
         data[1] = 1
         
@@ -549,17 +874,18 @@ class TestEvents(unittest.TestCase) :
             data[1] += 1
             test.append("action2:"+x)
 
-        table.notify(self.PBefore(self.PEnters("kyle", "vestibule")), data=data)
-        table.notify(self.PEnters("kyle", "vestibule"), data=data)
-        table.notify(self.PAfter(self.PEnters("kyle", "vestibule")), data=data)
+        table.notify(self.PBefore(self.PEnters("kyle", "vestibule")), {"data" : data})
+        table.notify(self.PEnters("kyle", "vestibule"), {"data" : data})
+        table.notify(self.PAfter(self.PEnters("kyle", "vestibule")), {"data" : data})
         self.assertEqual(test,
                          ["action2:vestibule","action1:vestibule", "action2:vestibule"])
+        self.assertEqual(data[1], 4)
 
     def test_stopping_test(self) :
-        table = ActionTable()
-        when = makeEventPatternDecorator(table)
+        table = RuleTable()
+        when = make_rule_decorator(table)
         test = []
-        x = PVar("x")
+        x = VarPattern("x")
         
         @when(self.PEnters("kyle", x))
         def action1(x) :
@@ -571,12 +897,68 @@ class TestEvents(unittest.TestCase) :
         def action2(x) :
             test.append("action2:"+x)
 
+        table.notify(self.PBefore(self.PEnters("kyle", "vestibule")), {})
+        self.assertRaises(AbortAction, table.notify, self.PEnters("kyle", "vestibule"), {})
+        self.assertEqual(test, ["action2:vestibule"])
+
+    def test_returned_signals(self) :
+        table = RuleTable(accumulator=list)
+        when = make_rule_decorator(table)
+        x = VarPattern("x")
+
+        @when(self.PEnters("kyle", x))
+        def first(x) :
+            return "first"
+        @when(self.PEnters("kyle", x))
+        def skipped(x) :
+            return NotHandled()
+        @when(self.PEnters("kyle", x))
+        def last(x) :
+            return ActionHandled("last")
+
+        self.assertEqual(table.notify(self.PEnters("kyle", "vestibule"), {}), ["last"])
+
+class TestPropertyTable(unittest.TestCase) :
+    class PName(BasicPattern) :
+        def __init__(self, x) :
+            self.args = [x]
+
+    def test_returned_not_handled_is_skipped(self) :
+        table = PropertyTable()
+        x = VarPattern("x")
+        table[self.PName(x)] = "default"
+        @table.handler(self.PName(x))
+        def not_handled(x) :
+            return NotHandled()
+        @table.handler(self.PName("kyle"))
+        def kyle() :
+            return NOT_HANDLED
+        self.assertEqual(table.get_property(self.PName("kyle"), {}), "default")
+        self.assertEqual(table.get_properties([self.PName("kyle"), self.PName("joe")], {}),
+                         ["default", "default"])
+
+    def test_returned_signals_are_raised(self) :
+        table = PropertyTable()
+        x = VarPattern("x")
+        table[self.PName(x)] = "default"
+        @table.handler(self.PName(x))
+        def handled(x) :
+            return ActionHandled("kyle")
+        self.assertRaises(ActionHandled, table.get_property, self.PName("kyle"), {})
+        self.assertRaises(ActionHandled, table.get_properties, [self.PName("kyle")], {})
+
+    def test_profiled_agrees(self) :
+        table = PropertyTable()
+        x = VarPattern("x")
+        table[self.PName(x)] = "default"
+        @table.handler(self.PName(x))
+        def not_handled(x) :
+            return NotHandled()
+        start_profiling()
         try :
-            table.notify(self.PBefore(self.PEnters("kyle", "vestibule")))
-            table.notify(self.PEnters("kyle", "vestibule"))
-            table.notify(self.PAfter(self.PEnters("kyle", "vestibule")))
-        except AbortAction :
-            self.assertEqual(test, ["action2:vestibule"])
+            self.assertEqual(table.get_property(self.PName("kyle"), {}), "default")
+        finally :
+            stop_profiling()
 
 if __name__=="__main__" :
     unittest.main(verbosity=2)
@@ -30,6 +30,22 @@ class BasicAction(BasicPattern) :
         AskingTo).  We need to be able to reset it."""
         self.args = list(self.args)
         self.args[0] = newactor
+    def all_objects_index(self) :
+        """Returns the index of the AllObjects argument of the action
+        (as in "take all"), or None if there isn't one."""
+        for i, arg in enumerate(self.args) :
+            if type(arg) is AllObjects :
+                return i
+        return None
+    def refers_to_all(self) :
+        """Returns whether the action, or an action which is one of its
+        arguments (as with AskingTo), has an AllObjects argument."""
+        for arg in self.args :
+            if type(arg) is AllObjects :
+                return True
+            elif isinstance(arg, BasicAction) and arg.refers_to_all() :
+                return True
+        return False
     def get_actor(self) :
         """An accessor method for the actor of the action. Assumed to
         be first element."""
@@ -85,10 +101,26 @@ class BasicAction(BasicPattern) :
             return (self.verb[0] + " " + dobj + " " + self.verb[1] + " " + iobj)
         else :
             raise Exception("Default gerund form only works with 1-3 args")
+class AllObjects(object) :
+    """The value of the "all" subparser, for commands like "take all"
+    and "drop all but the lamp".  The candidates are the objects, in
+    order, which all stood for when the command was parsed (see
+    Parser.all_candidates).  An action with one of these as an
+    argument is run for each candidate (see ActionSystem.expand_all)."""
+    def __init__(self, candidates, excluded=()) :
+        self.candidates = candidates
+        self.excluded = frozenset(excluded)
+    def __repr__(self) :
+        return "AllObjects(%r)" % (sorted(self.excluded),)
+
 ###
 ### Handling actions
 ###
 
+# The properties whose lookups are shared when verifying several
+# actions at once.
+SHARED_VERIFY_PROPERTIES = ["VisibleTo", "AccessibleTo"]
+
 class ActionSystem(object) :
     def __init__(self) :
         self.action_verify = RuleTable(doc="""Handles verifying actions for being
@@ -106,9 +138,34 @@ class ActionSystem(object) :
         self.before = make_rule_decorator(self.action_before)
         self.when = make_rule_decorator(self.action_when)
         self.report = make_rule_decorator(self.action_report)
+        # (repr(action), world version, actor) -> verify result, for
+        # the current turn.
+        self.verify_memo = dict()
+    def new_turn(self) :
+        """Forgets the verify results from the previous turn."""
+        self.verify_memo = dict()
     def verify_action(self, action, ctxt) :
         """Returns either the best reason for doing the action, or, if
-        there is a reason not to do it, the worst."""
+        there is a reason not to do it, the worst.  The result is
+        remembered for the rest of the turn so long as the world does
+        not change."""
+        if action.all_objects_index() is not None :
+            # the actions it expands to are verified when it is run
+            return LogicalOperation()
+        key = (repr(action), ctxt.world.version, ctxt.actor)
+        if not self.verify_memo.has_key(key) :
+            self.verify_memo[key] = self.__verify_action(action, ctxt)
+        return self.verify_memo[key]
+    def verify_actions(self, actions, ctxt) :
+        """Verifies each of the actions, returning a list of results.
+        The lookups of SHARED_VERIFY_PROPERTIES are shared between the
+        verifications."""
+        ctxt.world.start_memoizing(*SHARED_VERIFY_PROPERTIES)
+        try :
+            return [self.verify_action(action, ctxt) for action in actions]
+        finally :
+            ctxt.world.stop_memoizing()
+    def __verify_action(self, action, ctxt) :
         reasons = self.action_verify.notify(action, {"ctxt" : ctxt}, {"world" : ctxt.world})
         reasons = [r for r in reasons if r is not None]
         reasons.sort(key=lambda x : x.score)
@@ -119,6 +176,56 @@ class ActionSystem(object) :
                 return reasons[0]
             else :
                 return reasons[-1]
+    def expand_all(self, action, ctxt) :
+        """Returns the list of actions which an action like "take all"
+        stands for, or None if the action does not refer to all.  The
+        candidates are verified together, and only the actions which
+        are better than merely logical are kept, so that, for
+        instance, "take all" doesn't try to take what the actor
+        already has.  Then the all_includes actor activity has the
+        last word.
+
+        Only the action's own arguments are expanded.  An action which
+        has "all" inside another action (like "bob, take all") raises
+        AbortAction."""
+        i = action.all_objects_index()
+        if i is None :
+            if action.refers_to_all() :
+                raise AbortAction("{Bob|cap} can only ask for one thing at a time.", actor=action.get_actor())
+            return None
+        all_objects = action.args[i]
+        actor = action.get_actor()
+        actions = []
+        for o in all_objects.candidates :
+            if o != actor and o not in all_objects.excluded :
+                args = list(action.args)
+                args[i] = o
+                actions.append(type(action)(*args))
+        reasons = self.verify_actions(actions, ctxt)
+        return [a for a, r in zip(actions, reasons)
+                if r.score > ALL_CUTOFF and ctxt.activity.all_includes(a)]
+    def __run_all(self, action, actions, ctxt, silently) :
+        """Runs each of the actions from expand_all, prefixed by the
+        name of the object.  An AbortAction only stops the action it
+        came from.  Since earlier actions may change what all should
+        include (like taking the blue ball instead of the green one),
+        all_includes is checked again before each later action."""
+        if not actions :
+            verb = action.verb if type(action.verb) is str else action.verb[0]
+            raise AbortAction("There is nothing to %s." % verb)
+        i = action.all_objects_index()
+        for n, a in enumerate(actions) :
+            if n == 0 :
+                ctxt.write(str_with_objs("[The $x]:", x=a.args[i]))
+            elif ctxt.activity.all_includes(a) :
+                ctxt.write(str_with_objs("[break][The $x]:", x=a.args[i]))
+            else :
+                continue
+            try :
+                self.run_action(a, ctxt, silently=silently)
+            except AbortAction as ab :
+                if len(ab.args) > 0 :
+                    ctxt.write(*ab.args, **ab.kwargs)
     def run_action(self, action, ctxt, is_implied=False, write_action=False, silently=False) :
         """Runs an action by the following steps:
         * Verify - if the action is not reasonable, then the action fails
@@ -134,7 +241,14 @@ class ActionSystem(object) :
         write_action is a boolean or a string such as "(first %s)".
         If considered to be true, then describes action.
 
-        silently, if true, prevents reporting the action."""
+        silently, if true, prevents reporting the action.
+
+        If the action refers to all (as in "take all"), then it is
+        instead run for each of the actions from expand_all."""
+        actions = self.expand_all(action, ctxt)
+        if actions is not None :
+            self.__run_all(action, actions, ctxt, silently)
+            return
         if (write_action or is_implied) :
             if write_action is True : write_action = "(%s)"
             ctxt.write(write_action % action.gerund_form(ctxt))
@@ -216,6 +330,10 @@ class IllogicalNotVisible(BasicVerify) :
         self.score = 0
         self.reason = reason
 
+# An action which refers to all is only done with the objects for
+# which it is better than LogicalOperation.
+ALL_CUTOFF = 100
+
 def VeryLogicalOperation() :
     """For operations which are particularly apt."""
     return BasicVerify(150, "Very good.")
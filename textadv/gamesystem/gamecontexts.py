@@ -47,6 +47,48 @@ class SwitchContext(Exception) :
 
 ## the io object for ActorContext must implement "get_input" which
 ## functions as "raw_input", and "write" which functions as "print x,"
+##
+## Optionally, the io object may have the attributes:
+## * discard_output: if true, nothing written is evaluated.
+## * defers_output: if true, "write" is given DeferredText objects,
+##   which should be turned into strings with render_texts when the io
+##   flushes.  The io must also implement "render_pending", which
+##   renders everything written so far, for when the world is about to
+##   change.
+
+class DeferredText(object) :
+    """Text written by an ActorContext which has not been evaluated
+    yet.  It is evaluated in the world and by the actor as they were
+    when it was written, which the ActorContext ensures by rendering
+    pending text before the world changes.  The text is compiled right
+    away so that a malformed string is reported to the writer."""
+    def __init__(self, ctxt, text, actor) :
+        self.ctxt = ctxt
+        self.text = text
+        self.template = ctxt.stringeval.get_template(text)
+        self.actor = actor
+        self.world = ctxt.world
+    def render(self) :
+        old_world = self.ctxt.world
+        self.ctxt.world = self.world
+        try :
+            evaled = self.template(self.ctxt.stringeval, self.ctxt, self.actor)
+            return "".join([str(o) for o in evaled])
+        finally :
+            self.ctxt.world = old_world
+
+def render_texts(texts) :
+    """Turns the things written to an io object into strings, in
+    place.  If one fails to render, it is replaced by an empty string
+    before the exception is passed on, so that it is not tried
+    again."""
+    for i, text in enumerate(texts) :
+        if type(text) is DeferredText :
+            try :
+                texts[i] = text.render()
+            except :
+                texts[i] = ""
+                raise
 
 class ActorActivities(object) :
     """This is a table of activities that all actors use."""
@@ -66,10 +108,9 @@ class ActorActivities(object) :
         """Gets the activity table of the given name."""
         return self._activities[name]
     def call(self, name, *args, **kwargs) :
-        mykwargs = kwargs.copy()
-        if "disable" in mykwargs :
-            del mykwargs["disable"]
-        return self._activities[name].notify(args, mykwargs, disable=kwargs.get("disable", []))
+        # kwargs is already a fresh dictionary
+        disable = kwargs.pop("disable", None)
+        return self._activities[name].notify(args, kwargs, disable=disable)
     def copy(self) :
         naa = ActorActivities()
         for name, table in self._activities.iteritems() :
@@ -106,6 +147,9 @@ class ActorActivities(object) :
 
 #actoractivities = ActorActivities()
 
+# Commands which repeat the last action without parsing it again.
+AGAIN_COMMANDS = ["again", "g"]
+
 class ActorContext(GameContext) :
     """Represents the context in which the player is assuming the role
     of the actor.  The parser is the main parser in the parser module."""
@@ -120,16 +164,30 @@ class ActorContext(GameContext) :
         self.parser = parser
         self.stringeval = stringeval
         self.actoractivities = actoractivities
+        # the rest of a chain of commands like "take lamp. n"
+        self.pending_commands = []
+        # the action which "again" repeats
+        self.last_action = None
     def write(self, *stuff, **kwargs) :
         """Writes a line by evaluating the string using the utilities
         module.  If there is an actor, then the text is wrapped so
-        that the text is rendered as if the actor were doing it."""
+        that the text is rendered as if the actor were doing it.  If
+        the io defers output, the evaluation waits until the io
+        flushes or the world is about to change."""
+        if getattr(self.io, "discard_output", False) :
+            return
         if kwargs.has_key("actor") :
             stuff = [as_actor(s, kwargs["actor"]) for s in stuff]
-        newstuff = [self.stringeval.eval_str(s, self) for s in stuff]
-        self.io.write(*newstuff)
+        if getattr(self.io, "defers_output", False) :
+            texts = [DeferredText(self, s, self.actor) for s in stuff]
+            self.world.before_change = self.io.render_pending
+            self.io.write(*texts)
+        else :
+            newstuff = [self.stringeval.eval_str(s, self) for s in stuff]
+            self.io.write(*newstuff)
     def run(self, input=None, action=None) :
         self.world.set_property("Global", "inhibit_location_description_when_moved", value=False)
+        self.actionsystem.new_turn()
         if not self.world.get_property("Global", "game_started") :
             self.activity.start_game()
             vis_cont = self.world.get_property("VisibleContainer", self.world.get_property("Location", self.actor))
@@ -137,28 +195,48 @@ class ActorContext(GameContext) :
             self.io.set_status_var("headline", self.stringeval.eval_str(self.activity.make_current_location_headline(self.actor), self))
         try :
             if input is None and action is None:
-                input = self.io.get_input()
-                if input == "dump" :
-                    self.world.dump()
-                    return (self, {})
+                if self.pending_commands :
+                    # the output of the whole chain is flushed by the
+                    # next get_input
+                    self.write("[newline]")
+                    input = self.pending_commands.pop(0)
+                else :
+                    input = self.io.get_input()
+                    if input == "dump" :
+                        self.world.dump()
+                        return (self, {})
+                    commands = self.parser.split_commands(input)
+                    if len(commands) > 1 :
+                        input = commands[0]
+                        self.pending_commands = commands[1:]
             try :
-                if action is None :
+                if action is None and input.strip().rstrip(".").lower() in AGAIN_COMMANDS :
+                    if self.last_action is None :
+                        self.write("[char 91]There is no command to repeat.[char 93]")
+                        return (self, dict())
+                    action = self.parser.refresh_all_objects(self.last_action, self)
+                    disambiguated = False
+                elif action is None :
                     action, disambiguated = self.parser.handle_all(input, self, self.actionsystem.verify_action,
-                                                                   allow_period_at_end=True)
+                                                                   allow_period_at_end=True,
+                                                                   batch_verifier=self.actionsystem.verify_actions)
                 else :
                     disambiguated = True
+                self.last_action = action
                 try :
                     if disambiguated :
                         self.actionsystem.run_action(action, self, write_action=True)
                     else :
                         self.actionsystem.run_action(action, self)
                 except AbortAction as ab :
+                    self.pending_commands = []
                     self.world.set_property("Global", "inhibit_location_description_when_moved", value=True)
                     if len(ab.args) > 0 : # the AbortAction may contain a message
                         self.write(*ab.args, **ab.kwargs)
                 if self.world.get_property("Global", "end_game_message") :
                     self.activity.end_game_actions()
                     if self.world.get_property("Global", "end_game_message") :
+                        self.pending_commands = []
                         self.io.set_status_var("headline", "*** Game over ***")
                         self.io.flush()
                         return (None, {})
@@ -168,12 +246,17 @@ class ActorContext(GameContext) :
                 self.io.set_status_var("visible_container", vis_cont)
                 self.io.set_status_var("headline", self.stringeval.eval_str(self.activity.make_current_location_headline(self.actor), self))
             except parser.NoSuchWord as ex :
+                self.pending_commands = []
                 esc = escape_str(ex.word)
-                if esc == "." :
+                if "." in esc :
                     self.write("[char 91]I don't understand periods in sentences.[char 93]")
+                elif ex.suggestion :
+                    self.write("[char 91]I don't know what you mean by '%s'.  Did you mean '%s'?[char 93]"
+                               % (esc, escape_str(ex.suggestion)))
                 else :
                     self.write("[char 91]I don't know what you mean by '%s'.[char 93]" % esc)
             except parser.NoUnderstand :
+                self.pending_commands = []
                 self.write("[char 91]I don't understand what you mean.[char 93]")
             except parser.NoInput :
                 pass
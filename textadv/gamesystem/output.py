@@ -0,0 +1,137 @@
+# output.py
+#
+# A structured form for the text which the game writes.  The io
+# objects collect what was written into an OutputBuffer of typed
+# segments, and then each of them renders the segments in one pass as
+# HTML, as text for the terminal, or as JSON-ready dictionaries.
+
+import re
+import textwrap
+from textadv.gamesystem.utilities import make_action_link
+
+###
+### Segments
+###
+
+# A segment is a tuple (kind, text, action).  Only TEXT and LINK have
+# text, and only LINK has an action.
+
+TEXT = "text"
+PARAGRAPH = "paragraph"
+BREAK = "break"
+INDENT = "indent"
+LINK = "link"
+
+_CODE_KINDS = {"newline" : PARAGRAPH,
+               "break" : BREAK,
+               "indent" : INDENT}
+
+# Recognizes the formatting codes which the string evaluator passes
+# through, and the links made by make_action_link.  Links whose text
+# has brackets in it are left as plain text so that the formatting
+# codes inside them still get handled.
+_SEGMENT_RE = re.compile(r"\[(newline|break|indent)\]"
+                         r"|<a class=\"action\" href=\"\" onclick=\"return run_action\('((?:[^'\\]|\\.)*)'\);\">([^\[]*?)</a>",
+                         re.DOTALL)
+
+class OutputBuffer(object) :
+    """Holds the segments for a sequence of writes.  As with the old
+    join, consecutive writes are separated by a space."""
+    def __init__(self, texts=()) :
+        self.segments = []
+        self.num_writes = 0
+        for text in texts :
+            self.write(text)
+    def write(self, text) :
+        segments = self.segments
+        if self.num_writes :
+            segments.append((TEXT, " ", None))
+        self.num_writes += 1
+        pos = 0
+        for m in _SEGMENT_RE.finditer(text) :
+            if m.start() > pos :
+                segments.append((TEXT, text[pos:m.start()], None))
+            if m.group(1) :
+                segments.append((_CODE_KINDS[m.group(1)], None, None))
+            else :
+                segments.append((LINK, m.group(3), m.group(2).replace("\\'", "'")))
+            pos = m.end()
+        if pos < len(text) :
+            segments.append((TEXT, text[pos:], None))
+    def __len__(self) :
+        return len(self.segments)
+    def __iter__(self) :
+        return iter(self.segments)
+
+###
+### Renderers
+###
+
+def render_html(segments) :
+    """Renders the segments as a single HTML paragraph (or several, if
+    there are paragraph breaks)."""
+    out = ["<p>"]
+    for kind, text, action in segments :
+        if kind == TEXT :
+            out.append(text)
+        elif kind == LINK :
+            out.append(make_action_link(text, action))
+        elif kind == PARAGRAPH :
+            out.append("</p><p>")
+        elif kind == BREAK :
+            out.append("<br>")
+        elif kind == INDENT :
+            out.append("&nbsp;&nbsp;")
+    out.append("</p>")
+    return "".join(out)
+
+_whitespace_re = re.compile("\\s+")
+_tag_re = re.compile("<[^<]+?>")
+
+def _plain_text(text) :
+    """Collapses whitespace and strips out html."""
+    return _tag_re.sub("", _whitespace_re.sub(" ", text))
+
+def render_terminal(segments) :
+    """Renders the segments as wrapped lines of plain text."""
+    lines = []
+    line = []
+    run = []
+    for kind, text, action in segments :
+        if kind == TEXT or kind == LINK :
+            run.append(text)
+            continue
+        if run :
+            line.append(_plain_text("".join(run)))
+            run = []
+        if kind == INDENT :
+            line.append("  ")
+        else :
+            lines.append("".join(line))
+            line = []
+            if kind == PARAGRAPH :
+                lines.append("")
+    if run :
+        line.append(_plain_text("".join(run)))
+    lines.append("".join(line))
+    return "\n".join(["\n".join(textwrap.wrap(l)) for l in lines])
+
+def render_json(segments) :
+    """Renders the segments as a list of dictionaries which can be
+    given to json_encode.  Adjacent text is merged."""
+    out = []
+    run = []
+    for kind, text, action in segments :
+        if kind == TEXT :
+            run.append(text)
+            continue
+        if run :
+            out.append({"type" : TEXT, "text" : "".join(run)})
+            run = []
+        if kind == LINK :
+            out.append({"type" : LINK, "text" : text, "action" : action})
+        else :
+            out.append({"type" : kind})
+    if run :
+        out.append({"type" : TEXT, "text" : "".join(run)})
+    return out
@@ -24,19 +24,23 @@
 import string
 import re
 import itertools
+import heapq
 from textadv.core.patterns import VarPattern, AbstractPattern, ExpansionException
 from textadv.core.rulesystem import ActivityTable, ActionHandled
-from textadv.gamesystem.utilities import list_append, docstring
+from textadv.gamesystem.utilities import list_append, docstring, LRUCache
 from textadv.gamesystem.basicpatterns import *
-from textadv.gamesystem.actionsystem import BasicAction, IllogicalNotVisible
+from textadv.gamesystem.actionsystem import BasicAction, IllogicalNotVisible, AllObjects, VeryLogicalOperation
 
 ###
 ### Parser exceptions
 ###
 
 class NoSuchWord(Exception) :
-    def __init__(self, word) :
+    """The suggestion is a known word which is close to the word, or
+    None."""
+    def __init__(self, word, suggestion=None) :
         self.word = word
+        self.suggestion = suggestion
 
 class NoUnderstand(Exception) :
     pass
@@ -64,6 +68,15 @@ def product(xs, ys) :
             out.append(x+y)
     return out
 
+def iter_best_first(results) :
+    """Yields the Matched results in order of decreasing score.  Ties
+    are kept in their original order.  The results are kept in a heap,
+    so a caller which stops early doesn't pay for sorting them all."""
+    heap = [(-r.score, i, r) for i, r in enumerate(results)]
+    heapq.heapify(heap)
+    while heap :
+        yield heapq.heappop(heap)[2]
+
 def separate_object_words(words) :
     """Takes a list of words as returned by Words(ob), and segments
     them into the adjs and nouns.  Returns (adjs, nouns)."""
@@ -95,6 +108,12 @@ def parser_valid_description(myadjs, mynouns, objadjs, objnouns) :
 
 PARSER_ARTICLES = ["a", "an", "the", "some"]
 
+PARSE_CACHE_SIZE = 64
+
+# a period which ends a word and is followed by whitespace or the end
+# of the input ends a command in a chain
+COMMAND_SEPARATOR_RE = re.compile(r"(?<=\S)\.(?=\s|$)")
+
 ###
 ### Matched objects
 ###
@@ -123,6 +142,150 @@ class CallSubParser(object) :
     def __repr__(self) :
         return "CallSubParser(%r, %r)" % (self.name, self.var)
 
+###
+### For memoizing subparsers
+###
+
+class SpanEnd(object) :
+    """Stands in for the continuation when a subparser is run for the
+    chart, recording the index at which the subparser stopped."""
+    def __init__(self, i) :
+        self.i = i
+    def __repr__(self) :
+        return "SpanEnd(%r)" % self.i
+
+def _span_end(i) :
+    return [[SpanEnd(i)]]
+
+###
+### Vocabulary
+###
+
+def word_deletions(word, distance) :
+    """Returns the set of strings obtained by deleting at most
+    distance characters from the word (including the word itself)."""
+    out = set([word])
+    last = [word]
+    for d in xrange(0, distance) :
+        next_last = []
+        for w in last :
+            for i in xrange(0, len(w)) :
+                w2 = w[:i] + w[i+1:]
+                if w2 not in out :
+                    out.add(w2)
+                    next_last.append(w2)
+        last = next_last
+    return out
+
+def edit_distance(a, b) :
+    """The optimal string alignment distance between a and b:
+    insertions, deletions, substitutions, and transpositions of
+    adjacent characters each count as one edit."""
+    prev2 = None
+    prev = range(0, len(b)+1)
+    for i in xrange(1, len(a)+1) :
+        curr = [i] + [0]*len(b)
+        for j in xrange(1, len(b)+1) :
+            cost = 0 if a[i-1] == b[j-1] else 1
+            curr[j] = min(prev[j]+1, curr[j-1]+1, prev[j-1]+cost)
+            if i > 1 and j > 1 and a[i-1] == b[j-2] and a[i-2] == b[j-1] :
+                curr[j] = min(curr[j], prev2[j-2]+1)
+        prev2, prev = prev, curr
+    return prev[len(b)]
+
+class Vocabulary(object) :
+    """Keeps track of every word the parser could understand, both
+    from the grammar (known words) and from the Words of the objects
+    which may be referred to (thing words).  Lookups are hashed, and
+    a table of deletions is kept so that a misspelled word can be
+    given a suggestion without scanning the whole vocabulary (this is
+    the symmetric delete method)."""
+    MAX_DISTANCE = 2
+    def __init__(self) :
+        self.known_words = set()
+        self.thing_words = set()
+        self.deletions = dict() # deletion -> set of words
+    def max_distance(self, word) :
+        """Short words get fewer edits so that "n" doesn't suggest
+        every other short word."""
+        if len(word) <= 2 :
+            return 0
+        elif len(word) <= 6 :
+            return 1
+        else :
+            return self.MAX_DISTANCE
+    def __add_deletions(self, word) :
+        for w in word_deletions(word, self.max_distance(word)) :
+            self.deletions.setdefault(w, set()).add(word)
+    def __remove_deletions(self, word) :
+        for w in word_deletions(word, self.max_distance(word)) :
+            words = self.deletions[w]
+            words.discard(word)
+            if not words :
+                del self.deletions[w]
+    def add_known_words(self, *words) :
+        for word in words :
+            word = word.lower()
+            if word not in self.known_words :
+                if word not in self.thing_words :
+                    self.__add_deletions(word)
+                self.known_words.add(word)
+    def set_thing_words(self, words) :
+        """Replaces the thing words with the given words, updating the
+        deletion table for only those which changed."""
+        words = set(w.lower() for w in words)
+        for word in self.thing_words - words :
+            if word not in self.known_words :
+                self.__remove_deletions(word)
+        for word in words - self.thing_words :
+            if word not in self.known_words :
+                self.__add_deletions(word)
+        self.thing_words = words
+    def __contains__(self, word) :
+        return word in self.known_words or word in self.thing_words
+    def suggest(self, word) :
+        """Returns the closest word in the vocabulary to the given
+        word, or None if there is nothing close enough.  Ties go to
+        the alphabetically first word."""
+        word = word.lower()
+        distance = self.max_distance(word)
+        if distance == 0 :
+            return None
+        candidates = set()
+        for w in word_deletions(word, distance) :
+            candidates.update(self.deletions.get(w, ()))
+        best = None
+        for c in sorted(candidates) :
+            d = edit_distance(word, c)
+            if 0 < d <= distance and (best is None or d < best[0]) :
+                best = (d, c)
+        return best and best[1]
+    def copy(self) :
+        newvocab = Vocabulary()
+        newvocab.known_words = set(self.known_words)
+        newvocab.thing_words = set(self.thing_words)
+        for w, words in self.deletions.iteritems() :
+            newvocab.deletions[w] = set(words)
+        return newvocab
+
+###
+### Parse cache
+###
+
+class ParseCacheEntry(object) :
+    """What handle_all remembers about a parse: the results, the
+    referenceable objects they were parsed against, and the action
+    which was chosen from them (if any).  If keeps_case is set, the
+    results may have the words as they were typed, so the entry is
+    only used for input with the same capitalization."""
+    def __init__(self, words, keeps_case, results, current_objects, current_words, current_names) :
+        self.words = words
+        self.keeps_case = keeps_case
+        self.results = results
+        self.current_objects = current_objects
+        self.current_words = current_words
+        self.current_names = current_names
+        self.decision = None
 
 ###
 ### Construct documentation
@@ -131,7 +294,19 @@ class CallSubParser(object) :
 
 class Parser(object) :
     def __init__(self) :
-        self.KNOWN_WORDS = []
+        # (name, var, i, actor) -> list of spans, valid for one run_parser
+        self.parse_chart = None
+        # (lowercased words, world scope_version, actor, version of
+        # the parser tables) -> ParseCacheEntry
+        self.parse_cache = LRUCache(PARSE_CACHE_SIZE)
+        # the subparsers whose results have words as they were typed
+        # (rather than objects or lowercased words)
+        self.case_keeping_subparsers = set(["text"])
+        self.used_case_keeping = False
+        # if False, the action chosen for a cached parse is reused
+        # without verifying the results again
+        self.reverify_cached = True
+        self.vocabulary = Vocabulary()
         self.add_known_words(*PARSER_ARTICLES)
         # subparser takes (parser, var, input, i, ctxt, actor, next)
         self.subparsers = dict()
@@ -157,37 +332,116 @@ class Parser(object) :
                 self.current_objects[parser] = with_objs[parser]
             else :
                 self.current_objects[parser] = ctxt.world.activity.objects_of_kind(kind)
-            self.current_words[parser] = [separate_object_words(ctxt.world.get_property("Words", o))
-                                          for o in self.current_objects[parser]]
+            objs = list(self.current_objects[parser])
+            self.current_words[parser] = [separate_object_words(words)
+                                          for words in ctxt.world.get_many("Words", objs)]
             self.current_names[parser] = dict()
-            for o in self.current_objects[parser] :
-                self.current_names[parser][o] = " ".join(ctxt.stringeval.eval_str(ctxt.world.get_property("Name", o), ctxt).split())
+            for o, name in zip(objs, ctxt.world.get_many("Name", objs)) :
+                self.current_names[parser][o] = " ".join(ctxt.stringeval.eval_str(name, ctxt).split())
+    def current_name(self, parser, o, ctxt) :
+        """Gets the evaluated name of the object for the subparser.
+        Objects which aren't in current_objects (such as those given
+        to the object subparser) are named when they're first
+        asked about."""
+        names = self.current_names[parser]
+        try :
+            return names[o]
+        except KeyError :
+            name = names[o] = " ".join(ctxt.stringeval.eval_str(ctxt.world.get_property("Name", o), ctxt).split())
+            return name
+    def scope_objects(self, ctxt) :
+        """Gets a dictionary from the names of subparsers in
+        object_classes to the objects of their kinds which are in
+        scope for the actor, using the world's objects_in_scope
+        activity.  Subparsers whose kinds have no scope are left
+        out."""
+        scope = dict()
+        for parser, kind in self.object_classes.iteritems() :
+            objs = ctxt.world.activity.objects_in_scope(ctxt.actor, kind)
+            if objs is not None :
+                scope[parser] = objs
+        return scope
+    def all_candidates(self, ctxt, actor) :
+        """Gets the objects, in order, which "all" stands for, using
+        the world's objects_for_all activity.  If that gives None,
+        they are the objects in scope for the something subparser,
+        sorted."""
+        objs = ctxt.world.activity.objects_for_all(actor)
+        if objs is None :
+            objs = self.scope_objects(ctxt).get("something")
+            if objs is None :
+                objs = ctxt.world.activity.objects_of_kind(self.object_classes["something"])
+            objs = sorted(objs)
+        return list(objs)
+    def refresh_all_objects(self, action, ctxt) :
+        """Returns the action with the candidates of its AllObjects
+        argument (if it has one) found again from the world as it is
+        now.  This is for repeating a command like "take all" with
+        "again"."""
+        i = action.all_objects_index()
+        if i is None :
+            return action
+        args = list(action.args)
+        args[i] = AllObjects(self.all_candidates(ctxt, action.get_actor()), args[i].excluded)
+        return type(action)(*args)
     def add_object_class(self, parsername, kind) :
         """Sets up the object_classes dictionary for a subparser
         called parsername so that current_objects[parsername] will be
         loaded with objects of kind kind when init_current_objects is
         run.  The current_words[parsername] entry will be updated."""
         self.object_classes[parsername] = kind
+        self.invalidate_parse_cache()
     def add_known_words(self,*words) :
         """Helps let the user know which word was not recognized when
         they make a typo."""
-        self.KNOWN_WORDS.extend(words)
-    def __is_word_for_thing(self, word) :
-        for word_list in self.current_words.itervalues() :
-            for adjs,nouns in word_list :
-                if word in adjs or word in nouns :
-                    return True
-        return False
+        self.vocabulary.add_known_words(*words)
+        self.invalidate_parse_cache()
+    def invalidate_parse_cache(self) :
+        """Empties the cache of parse results.  Changes to parse_thing
+        and the subparser tables are noticed through their versions
+        (see tables_version), so this is only needed for other
+        changes which affect parsing."""
+        self.parse_cache.clear()
+    def tables_version(self) :
+        """Gives a number which changes whenever a handler is added
+        to or disabled in parse_thing or one of the subparser
+        tables."""
+        return self.parse_thing.version + sum(t.version for t in self.subparsers.itervalues())
 
     def define_subparser(self, name, doc=None) :
         self.subparsers[name] = ActivityTable(accumulator=list_append, doc=doc)
+        self.invalidate_parse_cache()
     def add_subparser(self, name, **kwargs) :
         def _add_subparser(f) :
             self.subparsers[name].add_handler(f, **kwargs)
+            self.invalidate_parse_cache()
             return f
         return _add_subparser
     def run_subparser(self, name, var, input, i, ctxt, actor, next) :
-        return self.subparsers[name].notify([self, var, input, i, ctxt, actor, next], {})
+        """Runs the subparser on the input starting at i.  While
+        run_parser is going, each subparser is run at most once per
+        (name, var, i, actor), and the spans it matched are then
+        shared between the continuations which ask for them."""
+        if name in self.case_keeping_subparsers :
+            self.used_case_keeping = True
+        if self.parse_chart is None :
+            return self.subparsers[name].notify([self, var, input, i, ctxt, actor, next], {})
+        key = (name, var, i, actor)
+        spans = self.parse_chart.get(key)
+        if spans is None :
+            spans = self.subparsers[name].notify([self, var, input, i, ctxt, actor, _span_end], {})
+            self.parse_chart[key] = spans
+        out = []
+        rests = dict()
+        for span in spans :
+            if not span or type(span[-1]) is not SpanEnd :
+                out.append(span) # the subparser didn't use the continuation
+                continue
+            i2 = span[-1].i
+            if not rests.has_key(i2) :
+                rests[i2] = next(i2)
+            out.extend(product([span[:-1]], rests[i2]))
+        return out
     def run_parser(self, name, input, ctxt) :
         """Like run_subparser, but matches the end of input, too."""
         def _end(i) :
@@ -195,7 +449,12 @@ class Parser(object) :
                 return [[]]
             else :
                 return []
-        return self.subparsers[name].notify([self, None, input, 0, ctxt, ctxt.actor, _end], {})
+        old_chart = self.parse_chart
+        self.parse_chart = dict()
+        try :
+            return self.run_subparser(name, None, input, 0, ctxt, ctxt.actor, _end)
+        finally :
+            self.parse_chart = old_chart
 
     def understand(self, text, result=None, dest="action") :
         """Takes a textual form of a command and adds it to the parser
@@ -312,39 +571,121 @@ class Parser(object) :
                 out.extend(product([[m]], rest))
             return out
 
+    def split_commands(self, input) :
+        """Splits a chain of commands such as "take lamp. n. then open
+        door" into a list of commands.  Empty commands are dropped.
+        Only a period at the end of a word separates commands, so
+        other periods are left for the parser to complain about."""
+        commands = []
+        for sentence in COMMAND_SEPARATOR_RE.split(input) :
+            command = []
+            for word in sentence.split() :
+                if word.lower() == "then" :
+                    if command :
+                        commands.append(" ".join(command))
+                    command = []
+                else :
+                    command.append(word)
+            if command :
+                commands.append(" ".join(command))
+        return commands
+
     def transform_text_to_words(self, text) :
         text = text.replace(",", " , ").replace("?", " ? ").replace("!", " ! ").strip()
         return text.split()
 
-    def handle_all(self, input, ctxt, action_verifier, allow_period_at_end=False) :
+    def handle_all(self, input, ctxt, action_verifier, allow_period_at_end=False, batch_verifier=None) :
         input = input.strip()
         if allow_period_at_end and input.endswith(".") :
             input = input[:-1]
         words = self.transform_text_to_words(input)
         if not words :
             raise NoInput()
-        self.init_current_objects(ctxt)
-        results = [r[0] for r in self.run_parser("action", words, ctxt)]
+        # The parse only depends on the words (and on their case only
+        # through the case_keeping_subparsers), the state of the world
+        # (through the referenceable objects and their words and
+        # names), the actor, and the parser tables.  Only a property
+        # which is declared scope_independent leaves the scope_version
+        # alone, and such a property must not affect parsing.
+        key = (tuple([w.lower() for w in words]), ctxt.world.scope_version, ctxt.actor, self.tables_version())
+        entry = self.parse_cache.get(key)
+        if entry is not None and entry.keeps_case and entry.words != words :
+            entry = None
+        if entry is None :
+            self.used_case_keeping = False
+            # First try only the objects in scope.  If that doesn't
+            # parse, try all of them so that the verifiers can say
+            # why they can't be used.
+            scope = self.scope_objects(ctxt)
+            self.init_current_objects(ctxt, with_objs=scope)
+            results = [r[0] for r in self.run_parser("action", words, ctxt)]
+            if not results and scope :
+                self.init_current_objects(ctxt)
+                results = [r[0] for r in self.run_parser("action", words, ctxt)]
+            entry = ParseCacheEntry(words, self.used_case_keeping, results,
+                                    self.current_objects, self.current_words, self.current_names)
+            self.parse_cache[key] = entry
+        else :
+            self.current_objects = entry.current_objects
+            self.current_words = entry.current_words
+            self.current_names = entry.current_names
+        results = entry.results
         if not results :
             # then maybe we didn't know one of the words
+            self.vocabulary.set_thing_words(w for word_list in self.current_words.itervalues()
+                                            for adjs, nouns in word_list
+                                            for w in itertools.chain(adjs, nouns))
             for word in words :
                 word = word.lower()
-                if word not in self.KNOWN_WORDS and not self.__is_word_for_thing(word) :
-                    raise NoSuchWord(word)
+                if word not in self.vocabulary :
+                    raise NoSuchWord(word, self.vocabulary.suggest(word))
             raise NoUnderstand()
-        action, did_disambiguate = self.disambiguate(results, ctxt, action_verifier)
+        if entry.decision is not None and not self.reverify_cached :
+            return entry.decision
+        action, did_disambiguate = self.disambiguate(results, ctxt, action_verifier, batch_verifier)
+        entry.decision = (action, did_disambiguate)
         return (action, did_disambiguate)
 
-    def disambiguate(self, results, ctxt, action_verifier) :
+    def disambiguate(self, results, ctxt, action_verifier, batch_verifier=None) :
         """Try to disambiguate the results if needed using the
         action_verifier to get whether things work.  Returns (action,
         did_disambiguate) pair, where did_disambiguate represents
-        whether there were multiple logical options."""
+        whether there were multiple logical options.
+
+        The results are verified best-first by parse score.  If the
+        best result has a strictly higher score than all the others
+        and is very logical (which no other verification is expected
+        to beat), it is returned, and the rest are only verified
+        until one is found which is acceptable (to know whether to say
+        that there was a disambiguation).
+        Otherwise, the rest are verified together with batch_verifier,
+        which takes a list of actions, if it is given, and ranked by
+        verification as usual."""
         if len(results) == 1 : # no need to disambiguate
             return results[0].value, False
         else : # it's ambiguous!
+            verified = dict()
+            best_first = iter_best_first(results)
+            best = best_first.next()
+            second = best_first.next()
+            if best.score > second.score :
+                verified[id(best)] = action_verifier(best.value, ctxt)
+                if verified[id(best)].score >= VeryLogicalOperation().score :
+                    # it wins, but there was a disambiguation if some
+                    # other result is acceptable too
+                    for r in itertools.chain([second], best_first) :
+                        if action_verifier(r.value, ctxt).is_acceptible() :
+                            return best.value, True
+                    return best.value, False
             # first, see if verification helps at all
-            scores_pre = [(r, action_verifier(r.value, ctxt)) for r in results]
+            to_verify = [r for r in results if not verified.has_key(id(r))]
+            if batch_verifier :
+                vs = batch_verifier([r.value for r in to_verify], ctxt)
+            else :
+                vs = [action_verifier(r.value, ctxt) for r in to_verify]
+            for r, v in zip(to_verify, vs) :
+                verified[id(r)] = v
+            scores_pre = [(r, verified[id(r)]) for r in results]
             # we separate out the ones which are illogical because
             # something wasn't visible because we don't want to even
             # mention the objects involved (because they weren't
@@ -443,11 +784,12 @@ class Parser(object) :
 
     def copy(self) :
         newparser = Parser()
-        newparser.KNOWN_WORDS = list(self.KNOWN_WORDS)
+        newparser.vocabulary = self.vocabulary.copy()
         for name, table in self.subparsers.iteritems() :
             newparser.subparsers[name] = table.copy()
         newparser.parse_thing = self.parse_thing.copy()
         newparser.object_classes = self.object_classes.copy()
+        newparser.reverify_cached = self.reverify_cached
         return newparser
     def make_documentation(self, escape, heading_level=1) :
         hls = str(heading_level)
@@ -485,7 +827,7 @@ def default_parse_thing(parser, subparser, var, name, words, input, i, ctxt, nex
             if input[i2].lower() in nouns :
                 # already a match because input[i2] is one of the nouns.
                 m2 = 1
-                if parser.current_names[subparser][name].lower() == " ".join(input[i:i2+1]).lower() :
+                if parser.current_name(subparser, name, ctxt).lower() == " ".join(input[i:i2+1]).lower() :
                     m2 += 0.5
                 poss.extend(product([[Matched(input[i:i2+1], name, 2*multiplier*m2, subparser, var=var)]],
                                     next(i2+1)))
@@ -493,7 +835,7 @@ def default_parse_thing(parser, subparser, var, name, words, input, i, ctxt, nex
         if len(curr_adjs) > 0 and not require_another :
             # already a match
             m2 = 1
-            if parser.current_names[subparser][name] == " ".join(input[i:i2]) :
+            if parser.current_name(subparser, name, ctxt) == " ".join(input[i:i2]) :
                 m2 += 0.5
             poss.extend(product([[Matched(input[i:i2], name, 1*multiplier*m2, subparser, var)]],
                                 next(i2)))
@@ -541,6 +883,33 @@ def default_object(parser, var, input, i, ctxt, actor, next) :
     return parser.parse_thing.notify([parser,"something",None,var,words,input,i,ctxt,next,2],{})
 
 
+default_parser.define_subparser("all", """Matches "all" or "everything," possibly
+followed by "but" or "except" and a thing to leave out.  The value is
+an AllObjects whose candidates come from Parser.all_candidates.""")
+
+PARSER_ALL_WORDS = ["all", "everything"]
+PARSER_ALL_BUT_WORDS = ["but", "except"]
+default_parser.add_known_words(*(PARSER_ALL_WORDS + PARSER_ALL_BUT_WORDS))
+
+@default_parser.add_subparser("all")
+def default_parse_all(parser, var, input, i, ctxt, actor, next) :
+    """Parses "all" and "all but [something]".  If the thing to leave
+    out is ambiguous, every thing it could be is left out."""
+    if i >= len(input) or input[i].lower() not in PARSER_ALL_WORDS :
+        return []
+    candidates = parser.all_candidates(ctxt, actor)
+    out = product([[Matched(input[i:i+1], AllObjects(candidates), 1, "all", var=var)]], next(i+1))
+    if i+1 < len(input) and input[i+1].lower() in PARSER_ALL_BUT_WORDS :
+        excluded = dict() # end of the thing -> what it could be
+        for span in parser.run_subparser("something", None, input, i+2, ctxt, actor, _span_end) :
+            if span and type(span[-1]) is SpanEnd :
+                excluded.setdefault(span[-1].i, set()).update(m.value for m in span[:-1])
+        for i2, objs in excluded.iteritems() :
+            out.extend(product([[Matched(input[i:i2], AllObjects(candidates, objs), 1, "all", var=var)]],
+                               next(i2)))
+    return out
+
+
 default_parser.define_subparser("text", """Just matches against any sequence of words.""")
 
 @default_parser.add_subparser("text")
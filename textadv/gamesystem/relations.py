@@ -9,6 +9,15 @@ from textadv.core.patterns import BasicPattern, VarPattern, NoMatchException, Ab
 from textadv.gamesystem.basicpatterns import *
 
 class Relation(BasicPattern) :
+    # If positional is true, then the relation places an object (its
+    # child) under a parent in the world's position index.  Only
+    # many-to-one and one-to-many relations can be positional.
+    positional = False
+    # If instance_of is true, the relation is R(object, kind), and if
+    # subkind_of is true, it is R(kind, parent kind).  The world keeps
+    # the extent of each kind using these (see World.extent).
+    instance_of = False
+    subkind_of = False
     @staticmethod
     def setup_table() :
         """Returns data which supports this relation, which is to be
@@ -38,6 +47,9 @@ class ManyToOneRelation(Relation) :
     def __init__(self, a, b) :
         """There can only be one instance of R(a, X) for any X."""
         self.args = [a, b]
+    def child_and_parent(self) :
+        """Gives (child, parent) if the relation is positional."""
+        return self.args[0], self.args[1]
     @staticmethod
     def setup_table() :
         return [dict(), [], dict()] # rel,bounded,cache
@@ -114,6 +126,9 @@ class OneToManyRelation(Relation) :
     def __init__(self, a, b) :
         """There can only be one instance of R(X, b) for any X."""
         self.args = [a, b]
+    def child_and_parent(self) :
+        """Gives (child, parent) if the relation is positional."""
+        return self.args[1], self.args[0]
     @staticmethod
     def setup_table() :
         return [dict(), [], dict()]
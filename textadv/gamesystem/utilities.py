@@ -5,6 +5,8 @@
 import string
 import itertools
 import re
+import collections
+import threading
 
 def list_append(xs) :
     #return itertools.chain.from_iterable(xs)
@@ -58,6 +60,44 @@ def add_direction_pair(dir, opp) :
     DIRECTION_INVERSES[dir] = opp
     DIRECTION_INVERSES[opp] = dir
 
+class LRUCache(object) :
+    """A dictionary-like cache which holds at most size entries.  When
+    it's full, the least recently used entry is discarded.  It may be
+    shared between threads (like the web server's game sessions), so
+    it is guarded by a lock."""
+    def __init__(self, size) :
+        self.size = size
+        self.data = collections.OrderedDict()
+        self.lock = threading.Lock()
+    def get(self, key, default=None) :
+        with self.lock :
+            try :
+                value = self.data.pop(key)
+            except KeyError :
+                return default
+            self.data[key] = value # move it to the end
+            return value
+    def __setitem__(self, key, value) :
+        with self.lock :
+            self.data.pop(key, None)
+            self.data[key] = value
+            if len(self.data) > self.size :
+                self.data.popitem(last=False)
+    def __contains__(self, key) :
+        with self.lock :
+            return key in self.data
+    def __len__(self) :
+        return len(self.data)
+    def clear(self) :
+        with self.lock :
+            self.data.clear()
+
+class MentionedSet(set) :
+    """A set which can also be added to with append, for code which
+    expects to be given a list of mentioned objects."""
+    def append(self, x) :
+        self.add(x)
+
 def docstring(s) :
     def _docstring(f) :
         f.__doc__ = s
@@ -142,6 +182,10 @@ def escape_str(input) :
     return re.sub(r"\[|\]|\$|{|}", _escape_str, input)
 
 
+TEMPLATE_CACHE_SIZE = 1024
+# Changes whenever the output of parse_str changes form.
+TEMPLATE_CACHE_VERSION = 1
+
 class MalformedException(Exception) :
     """For when the input to the StringEvaluator is malformed (as in,
     couldn't be parsed)."""
@@ -157,12 +201,32 @@ class StringEvaluator(object) :
 
     def __init__(self) :
         self.eval_functions = dict()
+        # source string -> compiled template.  Compiled templates look
+        # up eval functions when they are run, so the cache is shared
+        # between copies (which may be in different threads).
+        self.templates = LRUCache(TEMPLATE_CACHE_SIZE)
+        # (actor, is_me) -> (world version, reword table)
+        self.reword_tables = dict()
 
     def copy(self) :
         newse = StringEvaluator()
         newse.eval_functions = self.eval_functions.copy()
+        newse.templates = self.templates
         return newse
 
+    def reword_table(self, world, actor, is_me) :
+        """Gets the table from (word, is_obj) to rewritten word for
+        the actor, which is filled in lazily by the reword function.
+        The names and pronouns in the table come from properties
+        (which may depend on anything), so it is thrown away whenever
+        the world changes."""
+        key = (actor, is_me)
+        entry = self.reword_tables.get(key)
+        if entry is None or entry[0] != world.version :
+            entry = (world.version, dict())
+            self.reword_tables[key] = entry
+        return entry[1]
+
     def add_eval_func(self, name) :
         def _add_eval_func(f) :
             if name in self.eval_functions :
@@ -189,20 +253,40 @@ class StringEvaluator(object) :
         """
         if not actor :
             actor = context.actor
-        # first we need to parse the string
+        evaled = self.get_template(input)(self, context, actor)
+        return "".join([str(o) for o in evaled])
+
+    def get_template(self, input) :
+        """Gets the compiled template for the string from the cache,
+        compiling it if needed.  Raises MalformedException if the
+        string is malformed."""
+        template = self.templates.get(input)
+        if template is None :
+            try :
+                template = self.compile_str(input)
+            except MalformedException as x :
+                print "eval_str: Offending input is"
+                print input
+                raise x
+            self.templates[input] = template
+        return template
+
+    def parse_str(self, input) :
+        """Parses the string into the code which eval_str would run.
+        Raises MalformedException if the [if] and [as] structures are
+        malformed."""
         parsed, i = self.__eval_parse(input)
         code = ["append"]
-        try :
-            i = 0
-            while i < len(parsed) :
-                i, val = self.__collect_structures(parsed, i)
-                code.append(val)
-        except MalformedException as x :
-            print "eval_str: Offending input is"
-            print input
-            raise x
-        evaled = self.__eval(code, context, actor)
-        return "".join([str(o) for o in evaled])
+        i = 0
+        while i < len(parsed) :
+            i, val = self.__collect_structures(parsed, i)
+            code.append(val)
+        return code
+
+    def compile_str(self, input) :
+        """Returns the string compiled into a function of (eval,
+        context, actor) which returns the evaluated pieces."""
+        return self.compile_code(self.parse_str(input))
 
     def __eval_parse(self, input, i=0, in_code=False) :
         """Pulls out [] and {} expressions, labeling them as such.
@@ -307,32 +391,85 @@ class StringEvaluator(object) :
             else :
                 raise Exception("What kind of structure is this?", expr)
 
-    def __eval(self, expr, context, actor) :
+    def save_templates(self, filename, templates) :
+        """Writes the templates, a dictionary from source strings to
+        the code from parse_str, to a template cache file which may be
+        read by load_templates."""
+        import cPickle
+        f = open(filename, "wb")
+        try :
+            cPickle.dump({"version" : TEMPLATE_CACHE_VERSION, "templates" : templates}, f, 2)
+        finally :
+            f.close()
+
+    def load_templates(self, filename) :
+        """Compiles the templates from a file written by
+        save_templates into the template cache.  Returns how many were
+        loaded (none if the file is from another version)."""
+        import cPickle
+        f = open(filename, "rb")
+        try :
+            data = cPickle.load(f)
+        finally :
+            f.close()
+        if data.get("version") != TEMPLATE_CACHE_VERSION :
+            return 0
+        for input, code in data["templates"].iteritems() :
+            self.templates[input] = self.compile_code(code)
+        return len(data["templates"])
+
+    def compile_code(self, expr) :
+        """Turns the code from parse_str into nested closures.
+        Functions are looked up in eval_functions only when the
+        closure is run, so functions added later with add_eval_func
+        are found."""
         if expr[0] == "lit" :
-            return [expr[1]]
+            lit = expr[1]
+            def _lit(ev, context, actor) :
+                return [lit]
+            return _lit
         elif expr[0] == "if" :
-            res = self.__eval(expr[1], context, actor)
-            # res might be the empty list
-            if res and res[0] :
-                return self.__eval(expr[2], context, actor)
-            else :
-                return self.__eval(expr[3], context, actor)
+            pred = self.compile_code(expr[1])
+            cons = self.compile_code(expr[2])
+            alt = self.compile_code(expr[3])
+            def _if(ev, context, actor) :
+                res = pred(ev, context, actor)
+                # res might be the empty list
+                if res and res[0] :
+                    return cons(ev, context, actor)
+                else :
+                    return alt(ev, context, actor)
+            return _if
         elif expr[0] == "as" :
-            return self.__eval(expr[2], context, expr[1])
+            as_actor = expr[1]
+            content = self.compile_code(expr[2])
+            def _as(ev, context, actor) :
+                return content(ev, context, as_actor)
+            return _as
         elif expr[0] == "current_actor_is" :
             if len(expr) == 1 :
-                return [actor]
+                def _current_actor(ev, context, actor) :
+                    return [actor]
+                return _current_actor
             else :
-                return [actor == self.__eval(expr[1], context, actor)]
-        elif self.eval_functions.has_key(expr[0]) :
-            try :
-                args = [self.__eval(x, context, actor) for x in expr[1:]]
-                return self.eval_functions[expr[0]](self, actor, context, *args)
-            except TypeError :
-                print "String evaluator tried",expr
-                raise
+                other = self.compile_code(expr[1])
+                def _current_actor_is(ev, context, actor) :
+                    return [actor == other(ev, context, actor)]
+                return _current_actor_is
         else :
-            raise Exception("Unknown expr",expr)
+            name = expr[0]
+            args = [self.compile_code(x) for x in expr[1:]]
+            def _call(ev, context, actor) :
+                f = ev.eval_functions.get(name)
+                if f is None :
+                    raise Exception("Unknown expr",expr)
+                try :
+                    return f(ev, actor, context, *[a(ev, context, actor) for a in args])
+                except TypeError :
+                    print "String evaluator tried",expr
+                    raise
+            return _call
+
     def make_documentation(self, escape, heading_level=1) :
         import inspect
         hls = str(heading_level)
@@ -599,7 +736,13 @@ def _str_eval_reword(eval, actor, ctxt, *args) :
     flags = args[1:]
     is_me = (ctxt.actor == actor)
     capitalized = word[0] in string.uppercase
-    rewritten = _reword(word.lower(), flags, ctxt.world, actor, is_me)
+    table = eval.reword_table(ctxt.world, actor, is_me)
+    key = (word.lower(), "obj" in flags)
+    try :
+        rewritten = table[key]
+    except KeyError :
+        rewritten = _reword(word.lower(), flags, ctxt.world, actor, is_me)
+        table[key] = rewritten
     if capitalized or "cap" in flags:
         return _cap(rewritten)
     else :
@@ -620,6 +763,23 @@ _reword_replacements = {"is" : "are",
                         "isn't" : "aren't",
                         }
 
+# verb -> second person form.  Verbs don't depend on the world, so
+# these outlive the reword tables.
+_second_person_verbs = dict()
+
+def _second_person_verb(word) :
+    try :
+        return _second_person_verbs[word]
+    except KeyError :
+        if _reword_replacements.has_key(word) :
+            verb = _reword_replacements[word]
+        elif len(word)>3 and word[-3:]=="ies" :
+            verb = word[0:-3]+"y"
+        else : # take off the s
+            verb = word[0:-1]
+        _second_person_verbs[word] = verb
+        return verb
+
 def _reword(word, flags, world, actor, is_me) :
     if is_me :
         if word == "he" :
@@ -635,13 +795,8 @@ def _reword(word, flags, world, actor, is_me) :
                 return world.get_property("SubjectPronounIfMe", actor)
         elif word == "his" :
             return world.get_property("PossessivePronounIfMe", actor)
-        elif _reword_replacements.has_key(word) :
-            return _reword_replacements[word]
-        else : # assume it's a verb
-            if len(word)>3 and word[-3:]=="ies" :
-                return word[0:-3]+"y"
-            else : # take off the s
-                return word[0:-1]
+        else :
+            return _second_person_verb(word)
     else :
         if word == "he" :
             return world.get_property("SubjectPronoun", actor)
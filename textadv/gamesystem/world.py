@@ -1,18 +1,124 @@
 # world.py
 # The definition of the main world database.  Properties are what can be used to query the properties database
 
-from textadv.core.patterns import BasicPattern
+import itertools
+import array
+from textadv.core.patterns import BasicPattern, VarPattern
 from textadv.core.rulesystem import ActivityTable, PropertyTable, ActivityHelperObject
 
+# Versions are unique across all worlds, so a version also identifies
+# the world it came from.
+_world_versions = itertools.count(1)
+
+# Setting a property to an equal value of one of these types does not
+# change the world.
+_IMMUTABLE_TYPES = (type(None), bool, int, long, float, str, unicode, tuple)
+
+_EMPTY_SET = frozenset()
+
 
 class Property(BasicPattern) :
     """This is the main property class.  The numargs attribute must be
-    created."""
+    created.  If scope_independent is set, then changing the property
+    does not change the world's scope_version (this is for properties
+    like Global which only hold bookkeeping)."""
+    scope_independent = False
     def __init__(self, *args) :
         if len(args) != self.numargs :
             raise Exception("Property requires exactly "+str(self.numargs)+" arguments.")
         self.args = args
 
+class PropertyMemo(object) :
+    """Remembers the values of properties of certain types for as
+    long as the version of the world stays the same."""
+    def __init__(self, types) :
+        self.types = frozenset(types)
+        self.depth = 0
+        self.version = None
+        self.values = dict()
+    def get(self, world, item) :
+        if self.version != world.version :
+            self.version = world.version
+            self.values = dict()
+        try :
+            return self.values[item]
+        except KeyError :
+            version = self.version
+            value = world.properties.get_property(item, {"world" : world})
+            if self.version == version == world.version :
+                # (a handler may have changed the world meanwhile)
+                self.values[item] = value
+            return value
+
+# The bytes in a flag column: the flag wasn't set, or was set to
+# False or True.
+_FLAG_CODES = {None : 0, False : 1, True : 2}
+_FLAG_VALUES = (None, False, True)
+
+class FlagColumns(object) :
+    """Holds the values which flag properties (properties of one
+    object whose values are True or False) were set to during play.
+    Objects are numbered in the order they are first set, and each
+    property has a column of bytes indexed by these numbers."""
+    def __init__(self) :
+        self.types = _EMPTY_SET
+        self.ids = dict() # object -> index
+        self.objects = [] # index -> object
+        self.columns = dict() # property type -> array of flag codes
+    def declare(self, prop) :
+        if prop not in self.columns :
+            self.columns[prop] = array.array("B", [0]*len(self.objects))
+            self.types = frozenset(self.columns)
+    def get(self, item) :
+        """Gets the value the flag was set to, or None."""
+        i = self.ids.get(item.args[0])
+        if i is None :
+            return None
+        return _FLAG_VALUES[self.columns[type(item)][i]]
+    def set(self, item, value) :
+        """Sets the flag to True or False, or forgets it if the value
+        is None."""
+        obj = item.args[0]
+        i = self.ids.get(obj)
+        if i is None :
+            if value is None :
+                return
+            i = len(self.objects)
+            self.ids[obj] = i
+            self.objects.append(obj)
+            for column in self.columns.itervalues() :
+                column.append(0)
+        self.columns[type(item)][i] = _FLAG_CODES[value]
+    def objects_set_to(self, prop, value) :
+        code = _FLAG_CODES[value]
+        objects = self.objects
+        return [objects[i] for i, c in enumerate(self.columns[prop]) if c == code]
+    def copy(self) :
+        new = FlagColumns()
+        new.types = self.types
+        new.ids = self.ids.copy()
+        new.objects = list(self.objects)
+        new.columns = dict((prop, array.array("B", column)) for prop, column in self.columns.iteritems())
+        return new
+    def to_data(self, inv_property_types) :
+        return (self.objects, [(inv_property_types[prop], column.tostring())
+                               for prop, column in self.columns.iteritems()])
+    def from_data(self, data, property_types) :
+        """Makes the FlagColumns with the same declared properties
+        from what to_data gave."""
+        objects, columns = data
+        new = FlagColumns()
+        new.types = self.types
+        new.objects = list(objects)
+        new.ids = dict((o, i) for i, o in enumerate(objects))
+        for prop in self.columns :
+            new.columns[prop] = array.array("B", [0]*len(objects))
+        for name, s in columns :
+            prop = property_types[name]
+            if prop in new.columns :
+                new.columns[prop] = array.array("B", s)
+        return new
+
 class World(object) :
     def __init__(self) :
         self.properties = PropertyTable()
@@ -23,22 +129,169 @@ class World(object) :
         self.relations = dict()
         self.relation_handlers = []
         self.name_to_relation = dict()
+        self.positions = dict() # object -> (positional relation, parent)
+        self.position_chains = dict() # object -> list of (relation, parent) up to the top
+        self.position_children = dict() # parent -> set of objects positioned in it
+        self.extents = None # kind -> set of objects of the kind, made when needed
+        self.object_kinds = None # object -> frozenset of its kinds, made with the extents
+        self.property_versions = dict() # property type -> version when last set
+        self.relation_versions = dict() # relation -> version when last changed
+        self.derived = dict() # for caches which game code keeps in the world; not copied
         self._activities = dict()
         self.activity = ActivityHelperObject(self)
+        self.version = _world_versions.next()
+        self.scope_version = self.version
+        self.property_memo = None
+        self.property_cache = None
+        self.flags = None # FlagColumns for the declared flag properties
+        # called once right before the next change to the world
+        self.before_change = None
+    def touch(self, scope=True) :
+        """Gives the world a new version.  The version changes
+        whenever a property or relation is changed, so that caches
+        which depend on the state of the world know to recompute.  The
+        scope_version changes too unless scope is False."""
+        if self.before_change is not None :
+            before_change = self.before_change
+            self.before_change = None
+            before_change()
+        self.version = _world_versions.next()
+        if scope :
+            self.scope_version = self.version
     def set_game_defined(self) :
         """Set when it's time to close off arbitrary property
         definitions."""
         self.game_defined = True
     def __setitem__(self, item, value) :
         if self.game_defined :
-            self.modified_properties[item] = value
+            flags = self.flags
+            if flags is not None and type(item) in flags.types :
+                old = flags.get(item)
+                if old is None :
+                    old = self.modified_properties.get(item, self)
+            else :
+                flags = None
+                old = self.modified_properties.get(item, self)
+            if not (type(value) in _IMMUTABLE_TYPES and type(old) is type(value) and old == value) :
+                self.touch(scope=not getattr(item, "scope_independent", False))
+                self.property_versions[type(item)] = self.version
+            if flags is not None and type(value) is bool :
+                flags.set(item, value)
+                self.modified_properties.pop(item, None)
+            else :
+                if flags is not None :
+                    flags.set(item, None)
+                self.modified_properties[item] = value
         else :
+            self.touch()
+            self.property_versions[item.file_under()] = self.version
             self.properties[item] = value
+    def property_version(self, prop) :
+        """Returns the version of the world when a property of the
+        given type was last set (or 0).  Handlers added with the
+        handler decorator are not counted."""
+        return self.property_versions.get(prop, 0)
     def __getitem__(self, item) :
+        flags = self.flags
+        if flags is not None and type(item) in flags.types :
+            value = flags.get(item)
+            if value is not None :
+                return value
         if self.modified_properties.has_key(item) :
             return self.modified_properties[item]
+        memo = self.property_memo
+        if memo is not None and type(item) in memo.types :
+            return memo.get(self, item)
+        cache = self.property_cache
+        if cache is not None and type(item) in cache.types :
+            return cache.get(self, item)
         return self.properties.get_property(item, {"world" : self})
+    def get_many(self, name, objs, *extra) :
+        """Gets the property with the given name for each of the
+        objects, with the extra arguments after the object, giving
+        the list of values.  This is the same as asking for each in
+        turn, but the property table is gone through once for all of
+        them (see PropertyTable.get_properties)."""
+        prop = self.property_types[name]
+        items = [prop(o, *extra) for o in objs]
+        values = [None] * len(items)
+        memo = self.property_memo
+        if memo is None or prop not in memo.types :
+            memo = self.property_cache
+            if memo is not None and prop not in memo.types :
+                memo = None
+        flags = self.flags
+        if flags is not None and prop not in flags.types :
+            flags = None
+        to_get = []
+        for i, item in enumerate(items) :
+            if flags is not None :
+                value = flags.get(item)
+                if value is not None :
+                    values[i] = value
+                    continue
+            if item in self.modified_properties :
+                values[i] = self.modified_properties[item]
+            elif memo is not None :
+                values[i] = memo.get(self, item)
+            else :
+                to_get.append(i)
+        if to_get :
+            got = self.properties.get_properties([items[i] for i in to_get], {"world" : self})
+            for i, value in zip(to_get, got) :
+                values[i] = value
+        return values
+    def objects_with_flag(self, name, objs) :
+        """Gives those of the objects for which the flag property with
+        the given name is True.  The objects whose flag was set during
+        play are picked out from its column, and the rest are looked
+        up with get_many."""
+        objs = list(objs)
+        prop = self.property_types[name]
+        if self.flags is None or prop not in self.flags.types :
+            return [o for o, v in zip(objs, self.get_many(name, objs)) if v]
+        set_true = set(self.flags.objects_set_to(prop, True))
+        set_false = set(self.flags.objects_set_to(prop, False))
+        rest = [o for o in objs if o not in set_true and o not in set_false]
+        looked_up = set(o for o, v in zip(rest, self.get_many(name, rest)) if v)
+        return [o for o in objs if o in set_true or o in looked_up]
+    def declare_flags(self, *names) :
+        """Declares that the properties with the given names are
+        flags, which are properties of one object whose values are
+        True or False.  The values they are set to during play are
+        kept in FlagColumns rather than in modified_properties."""
+        if self.flags is None :
+            self.flags = FlagColumns()
+        for name in names :
+            prop = self.property_types[name]
+            if prop.numargs != 1 :
+                raise Exception("Flag property "+name+" must take exactly one argument.")
+            self.flags.declare(prop)
+    def cache_properties(self, *names) :
+        """Always remembers the values of the properties with the given
+        names while the world is unchanged (unlike start_memoizing,
+        which is temporary).  This is for properties like the lighting
+        ones which are read very often but only change when the world
+        does."""
+        types = [self.property_types[name] for name in names]
+        if self.property_cache is not None :
+            types.extend(self.property_cache.types)
+        self.property_cache = PropertyMemo(types)
+    def start_memoizing(self, *names) :
+        """Starts remembering the values of the properties with the
+        given names until stop_memoizing is called, or until the world
+        changes.  Calls may be nested, in which case the outermost
+        names are used."""
+        if self.property_memo is None :
+            self.property_memo = PropertyMemo([self.property_types[name] for name in names
+                                               if self.property_types.has_key(name)])
+        self.property_memo.depth += 1
+    def stop_memoizing(self) :
+        self.property_memo.depth -= 1
+        if self.property_memo.depth == 0 :
+            self.property_memo = None
     def handler(self, item) :
+        self.touch()
         return self.properties.handler(item)
 
     def _make_property(self, numargs, name) :
@@ -63,9 +316,125 @@ class World(object) :
         return self[self.property_types[name](*args)]
 
     def add_relation(self, relation) :
+        self.touch()
         relation.add_relation(self.relations[type(relation)])
+        self.relation_versions[type(relation)] = self.version
+        if relation.positional :
+            child, parent = relation.child_and_parent()
+            old = self.positions.get(child)
+            if old is not None :
+                self.position_children[old[1]].discard(child)
+            self.positions[child] = (type(relation), parent)
+            self.position_children.setdefault(parent, set()).add(child)
+            self.position_chains = dict()
+        elif relation.instance_of :
+            if self.extents is not None :
+                obj, kind = relation.args
+                chain = self._kind_chain(kind)
+                for k in chain :
+                    self.extents.setdefault(k, set()).add(obj)
+                self.object_kinds[obj] = self.object_kinds.get(obj, _EMPTY_SET).union(chain)
+        elif relation.subkind_of :
+            self.extents = None
     def remove_relation(self, relation) :
+        self.touch()
         relation.remove_relation(self.relations[type(relation)])
+        self.relation_versions[type(relation)] = self.version
+        if relation.positional :
+            child, parent = relation.child_and_parent()
+            pos = self.positions.get(child)
+            # (a variable parent, as the many-to-one relations require
+            # for removal, stands for whatever the parent is)
+            if (pos is not None and pos[0] is type(relation)
+                and (isinstance(parent, VarPattern) or pos[1] == parent)) :
+                del self.positions[child]
+                self.position_children[pos[1]].discard(child)
+                self.position_chains = dict()
+        elif relation.instance_of or relation.subkind_of :
+            self.extents = None
+    def relation_version(self, r) :
+        """Returns the version of the world when the relation r was
+        last added to or removed from (or 0)."""
+        return self.relation_versions.get(r, 0)
+    def position(self, x) :
+        """Returns (relation, parent) for the positional relation which
+        places x, or None if x is nowhere."""
+        return self.positions.get(x)
+    def children(self, x) :
+        """Returns the set of objects which are positioned directly in
+        (or on, or by, and so on) x.  The set must not be modified."""
+        return self.position_children.get(x, _EMPTY_SET)
+    def position_chain(self, x) :
+        """Returns the (relation, parent) pairs from the position of x
+        up to the outermost parent.  The list must not be modified."""
+        try :
+            return self.position_chains[x]
+        except KeyError :
+            pos = self.positions.get(x)
+            if pos is None :
+                chain = []
+            else :
+                chain = [pos] + self.position_chain(pos[1])
+            self.position_chains[x] = chain
+            return chain
+    def extent(self, kind) :
+        """Returns the set of objects which are of the kind, either
+        directly or through its subkinds.  The set must not be
+        modified."""
+        if self.extents is None :
+            self._index_extents()
+        return self.extents.get(kind, _EMPTY_SET)
+    def kinds_of(self, x) :
+        """Returns the frozenset of kinds whose extents have x."""
+        if self.extents is None :
+            self._index_extents()
+        return self.object_kinds.get(x, _EMPTY_SET)
+    def _kind_chain(self, kind) :
+        """Returns the kind followed by all of its ancestor kinds,
+        following every parent through every subkind_of relation."""
+        chain = [kind]
+        seen = set(chain)
+        i = 0
+        while i < len(chain) :
+            k = chain[i]
+            i += 1
+            for r,data in self.relations.iteritems() :
+                if r.subkind_of :
+                    for m in r(k, VarPattern("parent")).query_relation(data) :
+                        parent = m["parent"]
+                        if parent not in seen :
+                            seen.add(parent)
+                            chain.append(parent)
+        return chain
+    def _index_extents(self) :
+        """Rebuilds the extents from the relations."""
+        extents = dict()
+        chains = dict()
+        for r,data in self.relations.iteritems() :
+            if r.instance_of :
+                for m in r(VarPattern("obj"), VarPattern("kind")).query_relation(data) :
+                    kind = m["kind"]
+                    if kind not in chains :
+                        chains[kind] = self._kind_chain(kind)
+                    for k in chains[kind] :
+                        extents.setdefault(k, set()).add(m["obj"])
+        object_kinds = dict()
+        for k, objs in extents.iteritems() :
+            for obj in objs :
+                object_kinds.setdefault(obj, set()).add(k)
+        self.object_kinds = dict((obj, frozenset(ks)) for obj, ks in object_kinds.iteritems())
+        self.extents = extents
+    def _index_positions(self) :
+        """Rebuilds the position index from the relations."""
+        self.positions = dict()
+        self.position_chains = dict()
+        self.position_children = dict()
+        for r,data in self.relations.iteritems() :
+            if r.positional :
+                for m in r(VarPattern("a"), VarPattern("b")).query_relation(data) :
+                    child, parent = r(m["a"], m["b"]).child_and_parent()
+                    self.positions[child] = (r, parent)
+                    self.position_children.setdefault(parent, set()).add(child)
     def define_relation(self, r) :
         if self.game_defined :
             raise Exception("Can't define new relation when game is defined.")
@@ -118,6 +487,14 @@ class World(object) :
             newworld.relations[r] = r.copy(data)
         newworld.relation_handlers = list(self.relation_handlers)
         newworld.name_to_relation = self.name_to_relation.copy()
+        newworld.positions = self.positions.copy()
+        newworld.position_children = dict((p, set(cs)) for p, cs in self.position_children.iteritems())
+        newworld.property_versions = self.property_versions.copy()
+        newworld.relation_versions = self.relation_versions.copy()
+        if self.property_cache is not None :
+            newworld.property_cache = PropertyMemo(self.property_cache.types)
+        if self.flags is not None :
+            newworld.flags = self.flags.copy()
         for name, table in self._activities.iteritems() :
             newworld._activities[name] = table.copy()
         return newworld
@@ -126,16 +503,33 @@ class World(object) :
         mp = []
         for k,v in self.modified_properties.iteritems() :
             mp.append((self.inv_property_types[type(k)], k.args, v))
-        return pickle.dumps((mp, self.relations))
+        flags = None
+        if self.flags is not None :
+            flags = self.flags.to_data(self.inv_property_types)
+        return pickle.dumps((mp, self.relations, flags))
     def deserialize(self, data) :
         import pickle
         import copy
-        mp, rel = pickle.loads(data)
+        loaded = pickle.loads(data)
+        mp, rel = loaded[:2]
+        flags = loaded[2] if len(loaded) > 2 else None
         newworld = copy.copy(self)
         newworld.modified_properties = dict()
         for name, args, v in mp :
             newworld.modified_properties[self.property_types[name](*args)] = v
         newworld.relations = rel
+        if self.flags is not None :
+            newworld.flags = self.flags.from_data(flags or ([], []), self.property_types)
+        newworld._index_positions()
+        newworld.extents = None
+        newworld.property_versions = dict()
+        newworld.relation_versions = dict()
+        newworld.derived = dict()
+        newworld.property_memo = None
+        if self.property_cache is not None :
+            newworld.property_cache = PropertyMemo(self.property_cache.types)
+        newworld.before_change = None
+        newworld.touch()
         return newworld
 
     def dump(self) :
@@ -144,6 +538,11 @@ class World(object) :
         print "\n**Modified property table:**"
         for k,v in self.modified_properties.iteritems() :
             print "%r = %r" % (k,v)
+        if self.flags is not None :
+            for prop in self.flags.columns :
+                for value in (True, False) :
+                    for o in self.flags.objects_set_to(prop, value) :
+                        print "%r = %r" % (prop(o), value)
         print "\n**Relation tables:**"
         for r in self.relation_handlers :
             print " * For %s *" % r.__name__
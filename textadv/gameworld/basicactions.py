@@ -16,8 +16,9 @@ def require_xobj_accessible(actionsystem, action) :
     @actionsystem.verify(action)
     @docstring("Ensures the object x in "+repr(action)+" is accessible to the actor.  Added by require_xobj_accessible.")
     def _verify_xobj_accessible(actor, x, ctxt, **kwargs) :
-        if not ctxt.world[AccessibleTo(x, actor)] :
-            if not ctxt.world[VisibleTo(x, actor)] :
+        scope = actor_scope(ctxt.world, actor)
+        if not scope.is_accessible(x) :
+            if not scope.is_visible(x) :
                 return IllogicalNotVisible(as_actor("{Bob|cap} {can} see no such thing.", actor=actor))
             else :
                 effcont = ctxt.world[EffectiveContainer(ctxt.world[Location(x)])]
@@ -33,7 +34,7 @@ def require_xobj_visible(actionsystem, action) :
     @actionsystem.verify(action)
     @docstring("Ensures the object x in "+repr(action)+" is visible to the actor.  Added by require_xobj_visible.")
     def _verify_xobj_visible(actor, x, ctxt, **kwargs) :
-        if not ctxt.world[VisibleTo(x, actor)] :
+        if not actor_scope(ctxt.world, actor).is_visible(x) :
             return IllogicalNotVisible(as_actor("{Bob|cap} {can} see no such thing.", actor=actor))
 
 def require_xobj_held(actionsystem, action, only_hint=False, transitive=True) :
@@ -100,6 +101,23 @@ def reset_action_handler(handler, action) :
     def _reset_action_handler(**kwargs) :
         raise ActionHandled()
 
+###
+### Deciding what "all" includes
+###
+
+actoractivities.define_activity("all_includes", reverse=True, accumulator=lambda x : x[0],
+                                doc="""An activity which decides whether
+an action from a command like "take all" should be done.  It takes the
+action, which has already been verified.  Handlers should raise
+ActionHandled(False) to leave the action out, or NotHandled to let an
+earlier-defined handler decide.""")
+
+@actoractivities.to("all_includes")
+def all_includes_default(action, ctxt) :
+    """By default, all includes the things which are reported (so
+    scenery is left out)."""
+    raise ActionHandled(ctxt.world[Reported(action.get_do())])
+
 ###
 ### Action definitions
 ###
@@ -302,6 +320,8 @@ class Taking(BasicAction) :
 parser.understand("take/get/pickup [something x]", Taking(actor, X))
 parser.understand("pick up [something x]", Taking(actor, X))
 parser.understand("pick [something x] up", Taking(actor, X))
+parser.understand("take/get/pickup [all x]", Taking(actor, X))
+parser.understand("pick up [all x]", Taking(actor, X))
 
 all_are_mistakes(parser, ["take/get/pickup/pick", "pick up"],
                  """{Bob} {needs} to be taking something in particular.""")
@@ -309,6 +329,18 @@ all_are_mistakes(parser, ["take/get/pickup/pick", "pick up"],
 require_xobj_accessible(actionsystem, Taking(actor, X))
 hint_xobj_notheld(actionsystem, Taking(actor, X))
 
+@actoractivities.to("all_includes")
+def all_includes_taking(action, ctxt) :
+    """Taking all leaves out people, what the actor already has or
+    wears, what is fixed in place, and what is part of something."""
+    if type(action) is Taking :
+        actor, x = action.get_actor(), action.get_do()
+        if (ctxt.world[IsA(x, "person")] or ctxt.world[Owner(x)] == actor
+            or ctxt.world.query_relation(Wears(actor, x))
+            or ctxt.world[FixedInPlace(x)] or ctxt.world.query_relation(PartOf(x, Y))) :
+            raise ActionHandled(False)
+    return NOT_HANDLED
+
 @before(Taking(actor, X))
 def before_take_when_already_have(actor, x, ctxt) :
     """You can't take what you already have.  Uses the contents of the
@@ -386,6 +418,8 @@ class Dropping(BasicAction) :
 parser.understand("drop [something x]", Dropping(actor, X))
 parser.understand("put/set down [something x]", Dropping(actor, X))
 parser.understand("put/set [something x] down", Dropping(actor, X))
+parser.understand("drop [all x]", Dropping(actor, X))
+parser.understand("put/set down [all x]", Dropping(actor, X))
 
 all_are_mistakes(parser, ["drop/set", "put/set down"],
                  """{Bob} {needs} to be dropping something in particular.""")
@@ -480,7 +514,7 @@ def trybefore_going_setup_variables(action, actor, direction, ctxt) :
         action.going_via = None
         action.going_to = None
     else :
-        action.going_via = ctxt.world.query_relation(Exit(action.going_from, direction, Y), var=Y)[0]
+        action.going_via = room_topology(ctxt.world).exit_to[action.going_from][direction]
         action.going_to = action.going_via
         if ctxt.world[IsA(action.going_to, "door")] :
             action.going_to = ctxt.world.activity.door_other_side_from(action.going_to, action.going_from)
@@ -604,7 +638,7 @@ def before_going_to_intermediate_walk(actor, x, ctxt) :
     i = 1
     while i < len(path) :
         nextloc = path[i]
-        dir = ctxt.world.query_relation(Exit(currloc, Y, nextloc), var=Y)
+        dir = room_topology(ctxt.world).directions_to(currloc, nextloc)
         if not dir :
             raise AbortAction(str_with_objs("{Bob} {doesn't} know how to get to [get DefiniteName $y] from [get DefiniteName $z].", y=nextloc, z=currloc),
                               actor=actor)
@@ -697,7 +731,7 @@ def before_goinginto_check_nearby(actor, x, ctxt) :
     currloc = ctxt.world[ContainingRoom(actor)]
     path = ctxt.world.r_path_to(Adjacent, currloc, x,
                                 predicate=is_going_into_able)
-    dir = ctxt.world.query_relation(Exit(currloc, Y, path[1]), var=Y)[0]
+    dir = room_topology(ctxt.world).directions_to(currloc, path[1])[0]
     raise DoInstead(Going(actor, dir), suppress_message=True)
 
 ##
@@ -738,10 +772,10 @@ def before_entering_check_open(actor, x, ctxt) :
         # first check that we're not just inside.
         loc = ctxt.world[Location(actor)]
         if loc == x :
-            raise NotHandled()
+            return NOT_HANDLED
         while not ctxt.world[IsA(loc, "room")] :
             if loc == x :
-                raise NotHandled()
+                return NOT_HANDLED
             loc = ctxt.world[Location(loc)]
         # we're not just inside:
         ctxt.actionsystem.do_first(Opening(actor, x), ctxt, silently=True)
@@ -804,7 +838,7 @@ def before_entering_door(actor, x, ctxt) :
     """For doors, we translate entering into going in the appropriate
     direction."""
     vis_loc = ctxt.world[VisibleContainer(ctxt.world[Location(actor)])]
-    dir = ctxt.world.query_relation(Exit(vis_loc, Y, x), var=Y)[0]
+    dir = room_topology(ctxt.world).directions_to(vis_loc, x)[0]
     raise DoInstead(Going(actor, dir), suppress_message=True)
 
 @when(Entering(actor, X) <= IsA(X, "container"))
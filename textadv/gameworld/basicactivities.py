@@ -20,18 +20,51 @@ def default_def_obj(name, kind, world) :
 
 world.define_activity("move_backdrops", doc="""Updates the locations of backdrops given a current location.""")
 
-@world.to("move_backdrops")
-def default_move_backdrops(curr_loc, world) :
-    """Moves all relevant backdrops to curr_loc."""
-    for backdrop in world.activity.objects_of_kind("backdrop") :
+def backdrop_placements(world) :
+    """Returns (everywhere, by_location), where everywhere is the set
+    of backdrops which are everywhere and by_location maps each room
+    or region to the set of backdrops which list it in
+    BackdropLocations.  When BackdropLocations only has values (see
+    PropertyTable.only_values), this is kept in the world and only
+    remade when BackdropLocations is set or the kinds change.
+    Otherwise a handler might give anything, so it is remade every
+    time."""
+    cacheable = world.properties.only_values(BackdropLocations)
+    if cacheable :
+        key = (world.property_version(BackdropLocations), world.relation_version(IsA))
+        cached = world.derived.get("backdrop_placements")
+        if cached is not None and cached[0] == key :
+            return cached[1]
+    everywhere = set()
+    by_location = dict()
+    for backdrop in world.extent("backdrop") :
         locations = world[BackdropLocations(backdrop)]
         if locations == "everywhere" :
-            world.activity.put_in(backdrop, curr_loc)
+            everywhere.add(backdrop)
         else :
             for loc in locations :
-                if world[Contains(loc, curr_loc)] : # for handling regions
-                    world.activity.put_in(backdrop, curr_loc)
-                    break
+                by_location.setdefault(loc, set()).add(backdrop)
+    if cacheable :
+        world.derived["backdrop_placements"] = (key, (everywhere, by_location))
+    return everywhere, by_location
+
+@world.to("move_backdrops")
+def default_move_backdrops(curr_loc, world) :
+    """Moves all relevant backdrops to curr_loc.  A backdrop is
+    relevant if it is everywhere, or if one of its BackdropLocations
+    is curr_loc or a region which (transitively) contains it.  They
+    are moved in the order of objects_of_kind."""
+    everywhere, by_location = backdrop_placements(world)
+    relevant = set(everywhere)
+    relevant.update(by_location.get(curr_loc, ()))
+    for r, region in world.position_chain(curr_loc) :
+        if r is not Contains :
+            break
+        relevant.update(by_location.get(region, ()))
+    if relevant :
+        for backdrop in world.activity.objects_of_kind("backdrop") :
+            if backdrop in relevant :
+                world.activity.put_in(backdrop, curr_loc)
 
 ##
 ## Activity: get the doors in a room
@@ -43,9 +76,7 @@ world.define_activity("get_room_doors", accumulator=list_append,
 def default_get_room_doors(room, world) :
     """The doors in a room are those for which there is an exit from
     the room."""
-    neighbors = world.query_relation(Exit(room, X, Y), var=Y)
-    doors = [n for n in neighbors if world[IsA(n, "door")]]
-    return doors
+    return room_topology(world).doors.get(room, [])
 
 ##
 ## Activity: get the other side of a door
@@ -57,7 +88,7 @@ world.define_activity("door_other_side_from", accumulator=lambda x : x[0],
 def default_door_other_side_from(door, room, world) :
     """Given (door, room), gives the other room associated with the
     door."""
-    rooms = world.query_relation(Exit(door, X, Y), var=Y)
+    rooms = room_topology(world).destinations(door)
     if len(rooms) == 1 :
         raise Exception("Door only has one side")
     elif rooms[0] == room :
@@ -74,8 +105,8 @@ world.define_activity("get_room_exit_directions", accumulator=list_append,
 
 @world.to("get_room_exit_directions")
 def default_get_room_exit_directions(room, world) :
-    """Just looks through the Exit relation table."""
-    return world.query_relation(Exit(room, X, Y), var=X)
+    """Gets the directions from the room topology."""
+    return room_topology(world).directions(room)
 
 
 ###
@@ -115,7 +146,7 @@ def describe_location_init(actor, loc, vis_cont, ctxt) :
     """Initializes the global variables describe_location_notables and
     describe_location_mentioned."""
     ctxt.world[Global("describe_location_notables")] = []
-    ctxt.world[Global("describe_location_mentioned")] = []
+    ctxt.world[Global("describe_location_mentioned")] = MentionedSet()
 
 @actoractivities.to("describe_location")
 def describe_location_Heading(actor, loc, vis_cont, ctxt) :
@@ -152,29 +183,53 @@ def describe_location_Description(actor, loc, vis_cont, ctxt) :
 
 world[Global("describe_location_ascend_locations")] = True
 
+def scene_notables(actor, obs, ctxt, cache) :
+    """Gets the notable objects among obs (and their contents, through
+    get_notable_objects) ordered from most to least notable, with ties
+    kept in the order they were found.  An object is left out if any
+    of its entries has notability 0.  The cache maps objects to what
+    get_notable_objects gave for them, so that ascending through the
+    locations doesn't redo the subtree which was already looked at."""
+    best = {} # object -> (-notability, index of entry)
+    ignored = set()
+    i = 0
+    for o in obs :
+        try :
+            entries = cache[o]
+        except KeyError :
+            entries = cache[o] = ctxt.activity.get_notable_objects(actor, o)
+        for x,n in entries :
+            if n == 0 :
+                ignored.add(x)
+            else :
+                key = (-n, i)
+                if x not in best or key < best[x] :
+                    best[x] = key
+            i += 1
+    notables = [x for x in best if x not in ignored]
+    notables.sort(key=best.__getitem__)
+    return notables
+
 @actoractivities.to("describe_location")
 def describe_location_Objects(actor, loc, vis_cont, ctxt) :
     """Prints descriptions of the notable objects in the contents of
     the visible container."""
     continue_ascending = True
     mentioned = ctxt.world[Global("describe_location_mentioned")]
-    notables = ctxt.world[Global("describe_location_notables")]
     ascend = ctxt.world[Global("describe_location_ascend_locations")]
+    notables_cache = {}
     curr_msgs = []
     while continue_ascending :
         obs = ctxt.world[Contents(loc)]
-        raw_notables = list_append(ctxt.activity.get_notable_objects(actor, o) for o in obs)
-        to_ignore = [o for o,n in raw_notables if n==0]
-        filtered_notables = [(o,n) for o,n in raw_notables if o not in to_ignore]
-        filtered_notables.sort(key=lambda x : x[1], reverse=True)
-        notables = [o for o,n in filtered_notables]
+        ordered_notables = scene_notables(actor, obs, ctxt, notables_cache)
+        notables = frozenset(ordered_notables)
 
         unnotable_messages = []
         current_location = None
         is_first_sentence = loc==vis_cont or not ascend # the top level ends up printing first, unless we don't ascend
         current_start = None
         current_descs = None
-        for o in notables :
+        for o in ordered_notables :
             if o not in mentioned :
                 msg = ctxt.activity.terse_obj_description(actor, o, notables, mentioned)
                 mentioned.append(o)
@@ -304,7 +359,7 @@ def make_location_headline_ParentEnterable(actor, loc, vis_cont, ctxt) :
         else :
             break
         loc = ctxt.world[ParentEnterable(loc)] # hopefully the vis_cont is always an enterable!
-    raise MultipleResults(*out)
+    return MultipleResults(*out)
 
 ##
 ## Activity: terse_obj_description
@@ -352,8 +407,8 @@ def terse_obj_description_container(actor, o, notables, mentioned, ctxt) :
             elif not contents :
                 return "(which is empty)"
             else :
-                raise NotHandled()
-    else : raise NotHandled()
+                return NOT_HANDLED
+    else : return NOT_HANDLED
 
 @actoractivities.to("terse_obj_description")
 def terse_obj_description_supporter(actor, o, notables, mentioned, ctxt) :
@@ -366,7 +421,7 @@ def terse_obj_description_supporter(actor, o, notables, mentioned, ctxt) :
                 if msg : msgs.append(msg)
         if msgs :
             return "(on which "+is_are_list(msgs)+")"
-    raise NotHandled()
+    return NOT_HANDLED
 
 
 ##
@@ -387,41 +442,42 @@ def get_notable_objects_no_for_scenery(actor, x, ctxt) :
     returns [(x,0)] and stops executing the rest of the activity."""
     if ctxt.world[Scenery(x)] and ctxt.world[IsA(x, "container")] :
         raise ActionHandled([(x, 0)])
-    else : raise NotHandled()
+    else : return NOT_HANDLED
 @actoractivities.to("get_notable_objects")
 def get_notable_objects_thing(actor, x, ctxt) :
     """By default, returns (x, 1) to represent x not being very
     notable, but notable enough to be mentioned."""
     if ctxt.world[IsA(x, "thing")] :
         return [(x, 1)]
-    else : raise NotHandled()
+    else : return NOT_HANDLED
 @actoractivities.to("get_notable_objects")
 def get_notable_objects_container(actor, x, ctxt) :
     """Gets objects from the container"""
     if ctxt.world[IsA(x, "container")] :
         obs = ctxt.world[Contents(x)]
-        return list_append(ctxt.activity.get_notable_objects(actor, o) for o in obs if ctxt.world[VisibleTo(o, actor)])
-    else : raise NotHandled()
+        visible = ctxt.world.get_many("VisibleTo", obs, actor)
+        return list_append(ctxt.activity.get_notable_objects(actor, o) for o, v in zip(obs, visible) if v)
+    else : return NOT_HANDLED
 @actoractivities.to("get_notable_objects")
 def get_notable_objects_supporter(actor, x, ctxt) :
     """Gets objects from on the supporter."""
     if ctxt.world[IsA(x, "supporter")] :
         obs = ctxt.world[Contents(x)]
         return list_append(ctxt.activity.get_notable_objects(actor, o) for o in obs)
-    else : raise NotHandled()
+    else : return NOT_HANDLED
 @actoractivities.to("get_notable_objects")
 def get_notable_objects_not_reported(actor, x, ctxt) :
     """Prevents objects whose Reported is false from mentioning
     themselves or their contents."""
     if not ctxt.world[Reported(x)] :
         return [(x, 0)]
-    else : raise NotHandled()
+    else : return NOT_HANDLED
 @actoractivities.to("get_notable_objects")
 def get_notable_objects_not_self(actor, x, ctxt) :
     """If the object is the actor, then it's not reported."""
     if actor==x :
         return [(x, 0)]
-    else : raise NotHandled()
+    else : return NOT_HANDLED
 
 ##
 ## Activity: describe_object
@@ -447,7 +503,7 @@ def describe_object_container(actor, o, ctxt) :
     """Writes a line about the contents of a container if the container is not opaque."""
     if ctxt.world[IsA(o, "container")] :
         if ctxt.world[SuppressContentDescription(o)] :
-            raise NotHandled()
+            return NOT_HANDLED
         if not ctxt.world[IsOpaque(o)] :
             contents = [str_with_objs("[a $c]", c=c) for c in ctxt.world[Contents(o)] if c!=actor and ctxt.world[Reported(c)]]
             if contents :
@@ -465,7 +521,7 @@ def describe_object_supporter(actor, o, ctxt) :
     """Writes a line about the contents of a supporter."""
     if ctxt.world[IsA(o, "supporter")] :
         if ctxt.world[SuppressContentDescription(o)] :
-            raise NotHandled()
+            return NOT_HANDLED
         contents = [str_with_objs("[a $c]", c=c) for c in ctxt.world[Contents(o)] if c!=actor and ctxt.world[Reported(c)]]
         if contents :
             if ctxt.world[Global("describe_object_described")] : # print a newline if needed.
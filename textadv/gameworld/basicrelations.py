@@ -14,7 +14,10 @@
 ###
 
 # The following five are mutually exclusive relations which have to do
-# with the position of an object in the world.
+# with the position of an object in the world.  Since they are
+# positional, the world keeps an index from each object to the
+# relation and parent which place it (see World.position and
+# World.position_chain).
 
 @world.define_relation
 @world.define_property
@@ -22,27 +25,42 @@ class Contains(OneToManyRelation, Property) :
     """Contains(x,y) for "x Contains y".  As a property, represents
     whether something contains something transitively."""
     numargs = 2
+    positional = True
 
 @world.handler(Contains(X,Y))
-def property_handler_IsA(x, y, world) :
-    """Lets one ask whether X contains Y transitively."""
-    return world.r_path_to(Contains, x, y)
+def property_handler_Contains(x, y, world) :
+    """Lets one ask whether X contains Y transitively.  Gives the path
+    of containment from X to Y, or None."""
+    path = [y]
+    if x == y :
+        return path
+    for r, parent in world.position_chain(y) :
+        if r is not Contains :
+            return None
+        path.insert(0, parent)
+        if parent == x :
+            return path
+    return None
 
 @world.define_relation
 class Supports(OneToManyRelation) :
     """Supports(x,y) for "x Supports y"."""
+    positional = True
 
 @world.define_relation
 class Has(OneToManyRelation) :
     """Has(x,y) for "x Has y"."""
+    positional = True
 
 @world.define_relation
 class PartOf(ManyToOneRelation) :
     """PartOf(x,y) for "x PartOf y"."""
+    positional = True
 
 @world.define_relation
 class Wears(OneToManyRelation) :
     """Wears(x,y) for "x Wears y"."""
+    positional = True
 
 
 # The following are helper activities to make it easy to use these
@@ -109,35 +127,13 @@ class Location(Property) :
 
 world[Location(X)] = None
 @world.handler(Location(X))
-def object_location_Contains(x, world) :
-    """Gets the location of an object by what currently contains it."""
-    locs = world.query_relation(Contains(Y, x), var=Y)
-    if locs : return locs[0]
-    else : raise NotHandled()
-@world.handler(Location(X))
-def object_location_Has(x, world) :
-    """Gets the location of an object by what currently has it."""
-    locs = world.query_relation(Has(Y, x), var=Y)
-    if locs : return locs[0]
-    else : raise NotHandled()
-@world.handler(Location(X))
-def object_location_Supports(x, world) :
-    """Gets the location of an object by what currently supports it."""
-    locs = world.query_relation(Supports(Y, x), var=Y)
-    if locs : return locs[0]
-    else : raise NotHandled()
-@world.handler(Location(X))
-def object_location_PartOf(x, world) :
-    """Gets the location of an object by what it is currently part of."""
-    locs = world.query_relation(PartOf(x, Y), var=Y)
-    if locs : return locs[0]
-    else : raise NotHandled()
-@world.handler(Location(X))
-def object_location_Wears(x, world) :
-    """Gets the location of an object by what currently wears it."""
-    locs = world.query_relation(Wears(Y, x), var=Y)
-    if locs : return locs[0]
-    else : raise NotHandled()
+def object_location_position(x, world) :
+    """Gets the location of an object from the position index, which is
+    whatever contains, has, supports, or wears it, or what it is part
+    of."""
+    pos = world.position(x)
+    if pos : return pos[1]
+    else : return NOT_HANDLED
 
 
 @world.define_property
@@ -150,12 +146,11 @@ def rule_Owner_default(x, world) :
     """We assume that the owner of an object is the first object which
     Has some object which in some chain of containment (containment
     optional).  Returns None if no owner was found."""
-    poss_owner = world.query_relation(Has(Y, x), var=Y)
-    if poss_owner :
-        return poss_owner[0]
-    poss_container = world.query_relation(Contains(Y, x), var=Y)
-    if poss_container :
-        return world[Owner(poss_container[0])]
+    for r, parent in world.position_chain(x) :
+        if r is Has :
+            return parent
+        elif r is not Contains :
+            return None
     return None
 
 
@@ -166,6 +161,7 @@ def rule_Owner_default(x, world) :
 @world.define_relation
 class KindOf(ManyToOneRelation) :
     """Represents a class-like hierarchy."""
+    subkind_of = True
 
 @world.define_property
 @world.define_relation
@@ -174,41 +170,34 @@ class IsA(ManyToOneRelation, Property) :
     direct inheritence.  As a property, represents the transitive IsA
     relation."""
     numargs=2
+    instance_of = True
 
 @world.handler(IsA(X,Y))
 def property_handler_IsA(x, y, world) :
     """Lets one ask whether a particular object is of a particular
-    kind, searching up the KindOf tree."""
-    kind = world.query_relation(IsA(x, Z), var=Z)
-    if not kind :
-        return False
-    else :
-        return world.r_path_to(KindOf, kind[0], y)
+    kind, using the extent of the kind (which accounts for the KindOf
+    tree)."""
+    return x in world.extent(y)
 
 world.define_activity("referenceable_things", accumulator=list_append)
 @world.to("referenceable_things")
 def referenceable_things_Default(world) :
     """Gets all things in the world (that is, all objects which
     inherit from "thing")."""
-    objects = world.query_relation(IsA(X, Y), var=X)
-    things = [o for o in objects if world[IsA(o, "thing")]]
-    return things
+    return list(world.extent("thing"))
 
 world.define_activity("referenceable_rooms", accumulator=list_append)
 @world.to("referenceable_rooms")
-def referenceable_things_Default(world) :
-    """Gets all things in the world (that is, all objects which
-    inherit from "thing")."""
-    objects = world.query_relation(IsA(X, Y), var=X)
-    rooms = [o for o in objects if world[IsA(o, "room")]]
-    return rooms
+def referenceable_rooms_Default(world) :
+    """Gets all rooms in the world."""
+    return list(world.extent("room"))
 
 world.define_activity("objects_of_kind", accumulator=list_append)
 @world.to("objects_of_kind")
 def objects_of_type_Default(kind, world) :
-    """Gets all objects of a given kind."""
-    objects = world.query_relation(IsA(X, Y), var=X)
-    return [o for o in objects if world[IsA(o, kind)]]
+    """Gets all objects of a given kind.  (This is a copy of the
+    extent, so it may be gone through while the world changes.)"""
+    return list(world.extent(kind))
 
 ###
 ### Connecting rooms and doors together
@@ -233,3 +222,39 @@ def default_connect_rooms(room1, dir, room2, world, reverse=True) :
     if reverse :
         world.add_relation(Adjacent(room2, room1))
         world.add_relation(Exit(room2, inverse_direction(dir), room1))
+
+class RoomTopology(object) :
+    """An index of the Exit relation.  exits maps each room (or door)
+    to its (direction, destination) pairs in the order they were
+    added, exit_to maps each room to a dictionary from direction to
+    the first destination that way, and doors maps each room to the
+    doors it has exits to.  Get this using room_topology."""
+    def __init__(self, world) :
+        self.exits = dict()
+        self.exit_to = dict()
+        self.doors = dict()
+        for m in world.query_relation(Exit(X, Y, Z)) :
+            room, dir, dest = m["x"], m["y"], m["z"]
+            self.exits.setdefault(room, []).append((dir, dest))
+            self.exit_to.setdefault(room, dict()).setdefault(dir, dest)
+            if world[IsA(dest, "door")] :
+                self.doors.setdefault(room, []).append(dest)
+    def directions(self, room) :
+        """Gets the directions one can leave the room."""
+        return [dir for dir, dest in self.exits.get(room, ())]
+    def destinations(self, room) :
+        """Gets the destinations of the exits from the room (for a door,
+        its two sides)."""
+        return [dest for dir, dest in self.exits.get(room, ())]
+    def directions_to(self, room, dest) :
+        """Gets the directions from the room which lead to dest."""
+        return [dir for dir, d in self.exits.get(room, ()) if d == dest]
+
+def room_topology(world) :
+    """Gets the RoomTopology for the world, which is kept until the
+    Exit or IsA relations change."""
+    key = (world.relation_version(Exit), world.relation_version(IsA))
+    cached = world.derived.get("room_topology")
+    if cached is None or cached[0] != key :
+        cached = world.derived["room_topology"] = (key, RoomTopology(world))
+    return cached[1]
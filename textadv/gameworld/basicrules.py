@@ -246,6 +246,11 @@ class ContainsLight(Property) :
     contains light need not contribute light to its location."""
     numargs = 1
 
+# Lighting is asked about for every object in scope, but it only
+# changes when the world does, so the world keeps the values until
+# then.
+world.cache_properties("ContributesLight", "ContainsLight")
+
 @world.handler(ContainsLight(X) <= IsA(X, "room"))
 def rule_ContainsLight_room_default_is_MakesLight(x, world) :
     """A room, by default, contains light if it makes light itself."""
@@ -256,7 +261,7 @@ def rule_ContainsLight_contents_can_light_room(x, world) :
     """A room contains light if any of its contents contribute light."""
     if any(world[ContributesLight(o)] for o in world[Contents(x)]) :
         return True
-    else : raise NotHandled()
+    else : return NOT_HANDLED
 
 ##
 # Property: NoGoMessage
@@ -302,7 +307,7 @@ def rule_ContributesLight_thing_default_is_MakesLight(x, world) :
     containers or supporters."""
     if world[MakesLight(x)] :
         return True
-    else : raise NotHandled()
+    else : return NOT_HANDLED
 
 # Most things don't contain light
 world[ContainsLight(X) <= IsA(X, "thing")] = False
@@ -313,7 +318,7 @@ def rule_ContributesLight_if_parts_contribute(x, world) :
     parts = world.query_relation(PartOf(Y, x), var=Y)
     if any(world[ContributesLight(o)] for o in parts) :
         return True
-    else : raise NotHandled()
+    else : return NOT_HANDLED
 
 @world.handler(EffectiveContainer(X) <= IsA(X, "thing"))
 def rule_EffectiveContainer_if_thing(x, world) :
@@ -347,15 +352,11 @@ class ContainingRoom(Property) :
 
 @world.handler(ContainingRoom(X))
 def rule_ContainingRoom_default(x, world) :
-    """Walks up the Location chain until the object IsA room."""
-    loc = world[Location(x)]
-    if not loc :
-        return None
-    while not world[IsA(loc, "room")] :
-        loc = world[Location(loc)]
-        if not loc :
-            return None
-    return loc
+    """Walks up the position chain until the object IsA room."""
+    for r, loc in world.position_chain(x) :
+        if world[IsA(loc, "room")] :
+            return loc
+    return None
 
 
 ##
@@ -458,7 +459,7 @@ def rule_VisibleTo_if_held(x, actor, world) :
     if world.query_relation(Has(actor, x)) :
         return True
     else :
-        raise NotHandled()
+        return NOT_HANDLED
 
 @world.handler(VisibleTo(X, actor))
 def rule_VisibleTo_if_in_same_visible_container(x, actor, world) :
@@ -474,11 +475,11 @@ def rule_VisibleTo_if_in_same_visible_container(x, actor, world) :
         x_vis_cont = x
     else :
         loc = world[Location(x)]
-        if not loc : raise NotHandled()
+        if not loc : return NOT_HANDLED
         x_vis_cont = world[VisibleContainer(loc)]
     if actor_vis_cont == x_vis_cont and world[ContainsLight(actor_vis_cont)] :
         return True
-    raise NotHandled()
+    return NOT_HANDLED
 
 @world.handler(VisibleTo(X, actor))
 def rule_VisibleTo_if_part_of(x, actor, world) :
@@ -487,7 +488,7 @@ def rule_VisibleTo_if_part_of(x, actor, world) :
     x_assembly = world.query_relation(PartOf(x, Y), var=Y)
     if x_assembly and world[VisibleTo(x_assembly[0], actor)] :
         return True
-    raise NotHandled()
+    return NOT_HANDLED
 
 
 ##
@@ -518,14 +519,142 @@ def rule_not_AccessibleTo_if_different_effective_containers(x, actor, world) :
     if actor_eff_cont != x :
         if actor_eff_cont != world[EffectiveContainer(world[Location(x)])] :
             return False
-    raise NotHandled()
+    return NOT_HANDLED
 
 @world.handler(AccessibleTo(X, actor))
 def rule_not_AccessibleTo_if_not_visible(x, actor, world) :
     """If x is not visible to actor, then it's not accessible."""
     if not world[VisibleTo(x, actor)] :
         return False
-    else : raise NotHandled()
+    else : return NOT_HANDLED
+
+##
+# Scope
+##
+
+class ActorScope(object) :
+    """What an actor can see and reach, worked out once for a given
+    version of the world (get it with actor_scope).  The
+    candidates are the objects which scope_candidates gives; visible
+    and accessible are those candidates which are VisibleTo and
+    AccessibleTo the actor.  Objects which aren't candidates are asked
+    about directly, so is_visible and is_accessible always agree with
+    the rules.  known_rooms are the rooms the actor could mean to go
+    to."""
+    def __init__(self, world, actor) :
+        self.world = world
+        self.actor = actor
+        self.candidates = frozenset(world.activity.scope_candidates(actor))
+        self._visible = None
+        self._accessible = None
+        self._known_rooms = None
+    @property
+    def visible(self) :
+        if self._visible is None :
+            candidates = list(self.candidates)
+            visible = self.world.get_many("VisibleTo", candidates, self.actor)
+            self._visible = frozenset(o for o, v in zip(candidates, visible) if v)
+        return self._visible
+    @property
+    def accessible(self) :
+        if self._accessible is None :
+            visible = list(self.visible)
+            accessible = self.world.get_many("AccessibleTo", visible, self.actor)
+            self._accessible = frozenset(o for o, a in zip(visible, accessible) if a)
+        return self._accessible
+    @property
+    def known_rooms(self) :
+        """The current room, the visited rooms, and the rooms next to
+        a visited room (not through a door).  This mirrors
+        verify_going_default for GoingTo."""
+        if self._known_rooms is None :
+            world = self.world
+            visited = set(world.objects_with_flag("Visited", world.extent("room")))
+            known = set(visited)
+            for m in world.query_relation(Adjacent(X, Y)) :
+                if m["y"] in visited and not world[IsA(m["y"], "door")] :
+                    known.add(m["x"])
+            known.add(world[ContainingRoom(self.actor)])
+            self._known_rooms = frozenset(known)
+        return self._known_rooms
+    def is_visible(self, x) :
+        if x in self.candidates :
+            return x in self.visible
+        return self.world[VisibleTo(x, self.actor)]
+    def is_accessible(self, x) :
+        if x in self.candidates :
+            return x in self.accessible
+        return self.world[AccessibleTo(x, self.actor)]
+
+def actor_scope(world, actor) :
+    """Gets the ActorScope for the actor, which is shared until the
+    world changes.  Visibility and lighting may depend on any
+    property (even a Global), so this is keyed on the version rather
+    than the scope_version."""
+    scopes = world.derived.get("actor_scopes")
+    if scopes is None or scopes[0] != world.version :
+        scopes = world.derived["actor_scopes"] = (world.version, dict())
+    try :
+        return scopes[1][actor]
+    except KeyError :
+        scope = scopes[1][actor] = ActorScope(world, actor)
+        return scope
+
+world.define_activity("scope_candidates", accumulator=list_append,
+                      doc="""Gets the objects which might be
+                      visible to an actor, which are checked with
+                      VisibleTo to make the actor's scope.  Add
+                      handlers to this to let an actor refer to
+                      things which are somewhere else.""")
+
+@world.to("scope_candidates")
+def scope_candidates_visible_container(actor, world) :
+    """The candidates are the visible container of the actor's
+    location, everything positioned anywhere inside it, and its
+    doors."""
+    vis_cont = world[VisibleContainer(world[Location(actor)])]
+    out = [vis_cont]
+    to_visit = [vis_cont]
+    while to_visit :
+        children = world.children(to_visit.pop())
+        out.extend(children)
+        to_visit.extend(children)
+    out.extend(world.activity.get_room_doors(vis_cont))
+    return out
+
+world.define_activity("objects_in_scope", accumulator=lambda xs : xs[0] if xs else None,
+                      doc="""Takes (actor, kind) and gives the
+                      objects of that kind which the parser should
+                      try first for the actor, or None if it should
+                      just try all objects of that kind.""")
+
+@world.to("objects_in_scope")
+def objects_in_scope_things(actor, kind, world) :
+    """Things are tried from what the actor can see."""
+    if kind == "thing" :
+        return [o for o in actor_scope(world, actor).visible if world[IsA(o, "thing")]]
+    else : return NOT_HANDLED
+
+@world.to("objects_in_scope")
+def objects_in_scope_rooms(actor, kind, world) :
+    """Rooms are tried from the rooms the actor knows of."""
+    if kind == "room" :
+        return list(actor_scope(world, actor).known_rooms)
+    else : return NOT_HANDLED
+
+world.define_activity("objects_for_all", accumulator=lambda xs : xs[0] if xs else None,
+                      doc="""Takes an actor and gives the objects, in
+                      order, which "all" stands for in a command like
+                      "take all", or None if the parser should decide.
+                      The actions for them are still verified.""")
+
+@world.to("objects_for_all")
+def objects_for_all_default(actor, world) :
+    """All stands for the immediate contents of the actor's location,
+    then what the actor has, in the order of their contents."""
+    out = list(world[Contents(world[Location(actor)])])
+    out.extend(o for o in world[Contents(actor)] if o not in out)
+    return out
 
 ##
 # Property: IsOpaque
@@ -568,18 +697,12 @@ class ParentEnterable(Property) :
 
 @world.handler(ParentEnterable(X) <= IsA(X, "thing"))
 def rule_ParentEnterable_by_Location(x, world) :
-    """Gets either the next room or enterable by repeated calling of
-    Location."""
-    loc = world[Location(x)]
-    if not loc :
-        return None
-    while not world[IsA(loc, "room")] :
-        if world[IsEnterable(loc)] :
+    """Gets either the next room or enterable by walking up the
+    position chain."""
+    for r, loc in world.position_chain(x) :
+        if world[IsA(loc, "room")] or world[IsEnterable(loc)] :
             return loc
-        loc = world[Location(loc)]
-        if not loc :
-            return None
-    return loc
+    return None
 
 ##
 # Property: LocaleDescription
@@ -777,21 +900,21 @@ def rule_IsOpaque_if_openable_container_is_closed(x, world) :
     if world[Openable(x)] and not world[IsOpen(x)]:
         return True
     else :
-        raise NotHandled()
+        return NOT_HANDLED
 
 @world.handler(ContainsLight(X) <= IsA(X, "container"))
 def rule_ContainsLight_for_container(x, world) :
     """A container contains light if any of its contents contribute light."""
     if any(world[ContributesLight(o)] for o in world[Contents(x)]) :
         return True
-    else : raise NotHandled()
+    else : return NOT_HANDLED
 
 @world.handler(ContributesLight(X) <= IsA(X, "container"))
 def rule_ContributesLight_for_container(x, world) :
     """A container contributes light if it is not opaque and it contains light."""
     if not world[IsOpaque(x)] and world[ContainsLight(x)] :
         return True
-    else : raise NotHandled()
+    else : return NOT_HANDLED
 
 
 @world.handler(VisibleContainer(X) <= IsA(X, "container"))
@@ -859,14 +982,14 @@ def rule_ContainsLight_for_supporter(x, world) :
     light."""
     if any(world[ContributesLight(o)] for o in world[Contents(x)]) :
         return True
-    else : raise NotHandled()
+    else : return NOT_HANDLED
 
 @world.handler(ContributesLight(X) <= IsA(X, "supporter"))
 def rule_ContributesLight_for_supporter(x, world) :
     """A supporter contributes light if it contains light."""
     if world[ContainsLight(x)] :
         return True
-    else : raise NotHandled()
+    else : return NOT_HANDLED
 
 @world.handler(VisibleContainer(X) <= IsA(X, "supporter"))
 def rule_VisibleContainer_if_supporter(x, world) :
@@ -1017,7 +1140,7 @@ def rule_ContributesLight_possessions_can_light_person(x, world) : # maybe shoul
     """A person contributes light if any of their posessions contribute light."""
     if any(world[ContributesLight(o)] for o in world[Contents(x)]) :
         return True
-    else : raise NotHandled()
+    else : return NOT_HANDLED
 
 #
 # Willingness of NPCs to do stuff
@@ -1137,3 +1260,8 @@ world[NoSwitchMessages(X, "no_switch_on")] = "{Bob|cap} can't switch that on."
 world[NoSwitchMessages(X, "no_switch_off")] = "{Bob|cap} can't switch that off."
 world[NoSwitchMessages(X, "already_on")] = "That's already switched on."
 world[NoSwitchMessages(X, "already_off")] = "That's already switched off."
+
+# These flags are set over and over during play, so the world keeps
+# their values in columns rather than as modified properties.
+world.declare_flags("IsOpen", "IsLocked", "IsSwitchedOn", "Visited",
+                    "Scenery", "FixedInPlace", "Reported")
@@ -2,36 +2,314 @@
 
 # Contains an object which can be used for io in the terminal.
 
-import re
-import textwrap
+from textadv.gamesystem.gamecontexts import render_texts
+from textadv.gamesystem.output import OutputBuffer, render_terminal
 
 class TerminalGameIO(object) :
     """This class may be replaced in the GameContext by anything which
-    implements the following two methods."""
-    def __init__(self) :
+    implements the following two methods.  Output is rendered when it
+    is flushed, and is thrown away if discard_output is set."""
+    defers_output = True
+    def __init__(self, discard_output=False) :
         self.data = []
+        self.discard_output = discard_output
     def get_input(self, prompt=">") :
         self.flush()
         return raw_input("\n"+prompt + " ")
     def write(self, *data) :
-        self.data.extend(data)
+        if not self.discard_output :
+            self.data.extend(data)
+    def render_pending(self) :
+        render_texts(self.data)
     def set_status_var(self, *args, **kwargs) :
         pass
     def flush(self) :
-        d = " ".join(self.data)
+        self.render_pending()
+        buffer = OutputBuffer(self.data)
         self.data = []
-        d = " ".join(re.split("\\s+", d))
-        d = re.sub('<[^<]+?>', '', d) # strip out html
-        pars = d.replace("[newline]", "\n\n").replace("[break]", "\n").replace("[indent]","  ").split("\n")
-        wrapped = ["\n".join(textwrap.wrap(p)) for p in pars]
-        print "\n".join(wrapped),
-        return
-        paragraphs = re.split("\n\\s*\n", " ".join(data))
-        to_print = []
-        for p in paragraphs :
-            fixed = " ".join([l.strip() for l in p.strip().split("\n")])
-            one_p = []
-            for f in fixed.split("<br>") :
-                one_p.append("\n".join(textwrap.wrap(f)))
-            to_print.append("\n".join(one_p))
-        print string.replace("\n\n".join(to_print)+"\n", "&nbsp;", " ")
+        print render_terminal(buffer),
+
+###
+### Tests
+###
+
+import unittest
+
+class ScriptFinished(BaseException) :
+    """Raised by ScriptedIO when it runs out of commands.  It isn't an
+    Exception so that ActorContext.run lets it through."""
+    pass
+
+class ScriptedIO(TerminalGameIO) :
+    """An io for the tests which takes its input from a list of
+    commands.  The transcript has the plain text of what was written
+    for each command (the first entry is for the start of the game).
+    If between is set, between(i) is called before the ith command is
+    given."""
+    def __init__(self, commands, between=None) :
+        TerminalGameIO.__init__(self)
+        self.commands = list(commands)
+        self.between = between
+        self.transcript = [""]
+    def get_input(self, prompt=">") :
+        if not self.commands :
+            self.flush()
+            raise ScriptFinished()
+        command = self.commands.pop(0)
+        self.flush()
+        if self.between is not None :
+            self.between(len(self.transcript) - 1)
+        self.transcript.append("")
+        return command
+    def flush(self) :
+        self.render_pending()
+        buffer = OutputBuffer(self.data)
+        self.data = []
+        self.transcript[-1] += render_terminal(buffer)
+
+TEST_GAME = """
+quickdef(world, "Hall", "room", {
+        Description : "A bare hall.",
+        })
+quickdef(world, "Cellar", "room", {
+        Description : "A damp cellar.",
+        })
+world.activity.connect_rooms("Hall", "down", "Cellar")
+world.activity.put_in("player", "Hall")
+
+world[Global("power")] = True
+@world.handler(MakesLight("Cellar"))
+def cellar_light(world) :
+    return world[Global("power")]
+
+quickdef(world, "lamp", "thing", {
+        Words : ["brass", "@lamp"],
+        Description : "A brass lamp.",
+        })
+world.activity.put_in("lamp", "Cellar")
+
+quickdef(world, "red ball", "thing", {
+        Words : ["red", "@ball"],
+        }, put_in="Hall")
+quickdef(world, "blue ball", "thing", {
+        Words : ["blue", "@ball"],
+        }, put_in="Hall")
+quickdef(world, "box", "container", {
+        Words : ["@box"],
+        }, put_in="Hall")
+quickdef(world, "marble", "thing", {
+        Words : ["@marble"],
+        }, put_in="box")
+
+quickdef(world, "fog", "backdrop", {
+        Words : ["@fog"],
+        Description : "Thick fog.",
+        })
+world[Global("foggy_room")] = "Hall"
+@world.handler(BackdropLocations("fog"))
+def fog_locations(world) :
+    return [world[Global("foggy_room")]]
+"""
+
+def load_test_game(source=TEST_GAME) :
+    """Sets up a game from basicsetup and the source, giving the
+    namespace it was defined in.  Like the games, this must be run
+    from the top of the distribution."""
+    game = {"__name__" : "testgame"}
+    execfile("textadv/basicsetup.py", game)
+    exec source in game
+    return game
+
+def run_script(game, commands, between=None) :
+    """Plays the commands in a copy of the game, giving the
+    transcript.  If between is set, between(ctxt, i) is called before
+    the ith command."""
+    io = ScriptedIO(commands)
+    ctxt = game["make_actorcontext_with_io"](io)
+    if between is not None :
+        io.between = lambda i : between(ctxt, i)
+    try :
+        game["basic_begin_game"](ctxt)
+    except ScriptFinished :
+        pass
+    return io.transcript
+
+class TestActorScope(unittest.TestCase) :
+    def setUp(self) :
+        self.game = load_test_game()
+    def test_lighting_through_global(self) :
+        Global = self.game["Global"]
+        def power_off(ctxt, i) :
+            if i == 2 :
+                ctxt.world[Global("power")] = False
+        out = run_script(self.game, ["d", "x lamp", "x lamp", "take lamp"], power_off)
+        self.assertIn("A brass lamp.", out[2])
+        self.assertIn("You can see no such thing.", out[3])
+        self.assertIn("You can see no such thing.", out[4])
+        self.assertNotIn("Traceback", "".join(out))
+
+class TestCommands(unittest.TestCase) :
+    def setUp(self) :
+        self.game = load_test_game()
+    def run_script(self, commands, between=None) :
+        out = run_script(self.game, commands, between)
+        self.assertNotIn("Traceback", "".join(out))
+        return out
+    def test_take_all(self) :
+        out = self.run_script(["take all", "i"])
+        taken = [l[4:-len(": Taken.")] for l in out[1].splitlines() if l.endswith(": Taken.")]
+        self.assertEqual(set(["box", "red ball", "blue ball"]), set(taken))
+        # in the order the room lists them
+        seen = out[0][out[0].index("You see"):]
+        self.assertEqual(sorted(taken, key=seen.index), taken)
+        self.assertIn("marble", out[2]) # still in the box
+    def test_take_all_but(self) :
+        out = self.run_script(["take all but the red ball", "i"])
+        self.assertIn("The blue ball: Taken.", out[1])
+        self.assertNotIn("red ball", out[1])
+        self.assertNotIn("red ball", out[2])
+    def test_all_in_another_action(self) :
+        out = self.run_script(["player, take all"])
+        self.assertIn("one thing at a time", out[1])
+    def test_again_finds_all_again(self) :
+        def give_lamp(ctxt, i) :
+            if i == 2 :
+                ctxt.world.activity.give_to("lamp", "player")
+        out = self.run_script(["take red ball", "drop all", "again"], give_lamp)
+        self.assertIn("Dropped.", out[2])
+        self.assertIn("The lamp: Dropped.", out[3])
+    def test_again_without_command(self) :
+        out = self.run_script(["again"])
+        self.assertIn("There is no command to repeat.", out[1])
+    def test_command_chain(self) :
+        out = self.run_script(["take red ball. x blue ball then drop red ball", "i"])
+        self.assertIn("Taken.", out[1])
+        self.assertIn("nothing special about the blue ball", out[1])
+        self.assertIn("Dropped.", out[1])
+        self.assertIn("carrying nothing", out[2])
+    def test_chain_stops_at_error(self) :
+        out = self.run_script(["x fobble. take red ball", "i"])
+        self.assertIn("'fobble'", out[1])
+        self.assertIn("carrying nothing", out[2])
+    def test_periods_in_sentences(self) :
+        out = self.run_script(["x red.ball", "x red . ball"])
+        self.assertIn("I don't understand periods in sentences.", out[1])
+        self.assertIn("I don't understand periods in sentences.", out[2])
+    def test_split_commands(self) :
+        parser = self.game["parser"]
+        self.assertEqual(["take lamp", "n", "open door"], parser.split_commands("take lamp. n. then open door"))
+        self.assertEqual(["n", "s"], parser.split_commands("n.  s."))
+        self.assertEqual(["x red.ball"], parser.split_commands("x red.ball"))
+        self.assertEqual(["x red . ball"], parser.split_commands("x red . ball"))
+    def test_vocabulary_suggestions(self) :
+        out = self.run_script(["x rde ball", "x marbel", "x lampp"])
+        self.assertIn("Did you mean 'red'?", out[1])
+        self.assertIn("Did you mean 'marble'?", out[2])
+        self.assertIn("Did you mean 'lamp'?", out[3])
+
+class TestCacheInvalidation(unittest.TestCase) :
+    """Changes made between commands must be seen by the next one,
+    whatever was cached before."""
+    def setUp(self) :
+        self.game = load_test_game()
+    def run_script(self, commands, between=None) :
+        out = run_script(self.game, commands, between)
+        self.assertNotIn("Traceback", "".join(out))
+        return out
+    def test_words_change(self) :
+        Words = self.game["Words"]
+        def rename(ctxt, i) :
+            if i == 1 :
+                ctxt.world[Words("red ball")] = ["crimson", "@ball"]
+        out = self.run_script(["x red ball", "x red ball", "x crimson ball"], rename)
+        self.assertIn("nothing special", out[1])
+        self.assertIn("'red'", out[2])
+        self.assertIn("nothing special", out[3])
+    def test_name_change(self) :
+        Name = self.game["Name"]
+        def rename(ctxt, i) :
+            if i == 1 :
+                ctxt.world[Name("blue ball")] = "cobalt ball"
+        out = self.run_script(["x blue ball", "take blue ball", "i"], rename)
+        self.assertIn("blue ball", out[1])
+        self.assertIn("cobalt ball", out[3])
+        self.assertNotIn("blue ball", out[3])
+    def test_object_moved(self) :
+        def move_lamp(ctxt, i) :
+            if i == 1 :
+                ctxt.world.activity.put_in("lamp", "Hall")
+        out = self.run_script(["x lamp", "x lamp"], move_lamp)
+        self.assertIn("You can see no such thing.", out[1])
+        self.assertIn("A brass lamp.", out[2])
+    def test_backdrop_through_global(self) :
+        Global = self.game["Global"]
+        def move_fog(ctxt, i) :
+            if i == 1 :
+                ctxt.world[Global("foggy_room")] = "Cellar"
+        out = self.run_script(["x fog", "d", "x fog"], move_fog)
+        self.assertIn("Thick fog.", out[1])
+        self.assertIn("Thick fog.", out[3])
+    def test_parse_thing_handler(self) :
+        parser = self.game["parser"]
+        out = self.run_script(["x blue ball"])
+        self.assertIn("nothing special", out[1])
+        @parser.parse_thing.add_handler
+        def parse_nothing(*args) :
+            raise self.game["ActionHandled"]([])
+        out = self.run_script(["x blue ball"])
+        self.assertNotIn("nothing special", out[1])
+
+def forget_caches(ctxt) :
+    """Throws away everything which the game has cached, so that the
+    next command runs as if nothing had been."""
+    from textadv.gamesystem.world import PropertyMemo
+    world = ctxt.world
+    world.derived.clear()
+    world.extents = None
+    world.object_kinds = None
+    world._index_positions()
+    if world.property_cache is not None :
+        world.property_cache = PropertyMemo(world.property_cache.types)
+    world.properties.buckets = dict()
+    ctxt.parser.parse_cache.clear()
+    ctxt.stringeval.reword_tables.clear()
+    ctxt.actionsystem.verify_memo = dict()
+
+class TestCachedEquivalence(unittest.TestCase) :
+    """Playing with the caches must give the same transcript as
+    throwing them away before every command, even when a Global, a
+    property and a relation are changed between commands."""
+    commands = ["take all", "i", "d", "x lamp", "x lamp", "take lamp", "u",
+                "x red ball", "x red ball", "x crimson ball", "x fog", "drop all",
+                "x blue ball", "d", "x lamp", "take lamp", "x fog", "x blue ball", "u",
+                "take all", "again", "i"]
+    def mutate(self, ctxt, i) :
+        Global, Name, Words = self.game["Global"], self.game["Name"], self.game["Words"]
+        if i == 4 :
+            ctxt.world[Global("power")] = False
+        elif i == 8 :
+            ctxt.world[Name("red ball")] = "crimson ball"
+            ctxt.world[Words("red ball")] = ["crimson", "@ball"]
+        elif i == 10 :
+            ctxt.world[Global("foggy_room")] = "Cellar"
+        elif i == 12 :
+            ctxt.world.activity.put_in("blue ball", "Cellar")
+        elif i == 13 :
+            ctxt.world[Global("power")] = True
+            ctxt.world.activity.put_in("marble", "Cellar")
+        elif i == 20 :
+            ctxt.world.activity.put_in("box", "Hall")
+    def test_equivalence(self) :
+        self.game = load_test_game()
+        cached = run_script(self.game, self.commands, self.mutate)
+        def uncached_mutate(ctxt, i) :
+            self.mutate(ctxt, i)
+            forget_caches(ctxt)
+        uncached = run_script(self.game, self.commands, uncached_mutate)
+        self.assertNotIn("Traceback", "".join(cached))
+        self.assertEqual(len(self.commands) + 1, len(cached))
+        for i, (c, u) in enumerate(zip(cached, uncached)) :
+            self.assertEqual(u, c, "after %r" % (self.commands[i-1] if i else "the start"))
+
+if __name__=="__main__" :
+    unittest.main(verbosity=2)
@@ -12,6 +12,7 @@ import mimetypes
 import email
 import datetime
 from textadv.core.patterns import VarPattern
+from textadv.core import rulesystem
 
 sys.path.append(os.path.join(os.path.dirname(__file__), "../.."))
 
@@ -28,6 +29,10 @@ def add_game(package, name, auxfile_dir=None, altindex=None) :
         games[name] = __import__(name, fromlist=[name])
     else :
         games[name] = __import__(package+"."+name, fromlist=[name])
+    template_file = os.path.splitext(games[name].__file__)[0]+".templates"
+    if os.path.exists(template_file) :
+        # written by checkgame
+        print "Loaded", games[name].stringeval.load_templates(template_file), "templates for", name
     if auxfile_dir :
         auxfiles[name] = auxfile_dir
     if altindex :
@@ -174,7 +179,8 @@ class OutputHandler(tornado.web.RequestHandler) :
             print "waiting for output"
             def _output_handler(vars) :
                 tornado.ioloop.IOLoop.instance().add_callback(lambda : self.__finish_output(vars))
-            t.game_context.io.register_wants_output(_output_handler)
+            structured = bool(self.get_argument("structured", False))
+            t.game_context.io.register_wants_output(_output_handler, structured=structured)
     def __finish_output(self, vars) :
         self.output_lock.acquire()
         if self.ignore_output :
@@ -304,6 +310,19 @@ class StatusHandler(tornado.web.RequestHandler) :
                     except Exception as x :
                         result += "<p>Exception %r</p>" % (x,)
                 sessions_lock.release()
+            elif args[0] == "profile" :
+                a = self.get_argument("action", "")
+                if a == "start" :
+                    rulesystem.start_profiling()
+                    result += "<p>Started rule profiling.</p>"
+                elif a == "stop" :
+                    if rulesystem.stop_profiling() :
+                        result += "<p>Stopped rule profiling.</p>"
+                elif a == "json" :
+                    profiler = rulesystem.get_profiler()
+                    self.set_header("Content-Type", "application/json")
+                    self.write(json_encode(profiler.results() if profiler else []))
+                    return
             elif args[0] == "log" :
                 s = url_unescape(self.get_argument("session", ""))
                 print "log for",s
@@ -322,7 +341,10 @@ class StatusHandler(tornado.web.RequestHandler) :
         sessions_lock.acquire()
         the_sessions = sessions.items()
         sessions_lock.release()
-        self.render("static/status.html", result=result, sessions=the_sessions)
+        profiler = rulesystem.get_profiler()
+        self.render("static/status.html", result=result, sessions=the_sessions,
+                    profiling=profiler is not None,
+                    profile=profiler.results()[:40] if profiler else [])
 
 application = tornado.web.Application(
     [(r"/", MainHandler),
@@ -335,40 +357,55 @@ application = tornado.web.Application(
     static_path=os.path.join(os.path.dirname(__file__), "static"))
 
 import threading
+from textadv.gamesystem.gamecontexts import render_texts
+from textadv.gamesystem.output import OutputBuffer, PARAGRAPH, render_html, render_json
 
 class TornadoGameIO(object) :
+    defers_output = True
     def __init__(self, outfile, frontispiece=None) :
         self.main_lock = threading.BoundedSemaphore(1)
         self.input_lock = threading.Semaphore(0)
         self.to_flush = []
         self.commands = []
-        self.to_output = ""
+        self.to_output = [] # (OutputBuffer, html) for each flush
         self.wants_output = None
+        self.wants_structured = False
         self.status_vars = {"prompt" : ">"}
         self.die = False
         self.outfile = outfile
         self.frontispiece = frontispiece
-    def register_wants_output(self, callback) :
+    def register_wants_output(self, callback, structured=False) :
+        """Registers a callback for the next output.  If structured is
+        set, the output also has the segments as a list of
+        dictionaries."""
         self.main_lock.acquire()
         if self.to_output :
             if self.wants_output :
-                self.status_vars["text"] = self.to_output
-                self.wants_output(self.status_vars)
-                self.status_vars = {"prompt" : self.status_vars["prompt"]}
+                self.__send_output(self.wants_output, self.wants_structured)
                 self.wants_output = callback
-                self.to_output = ""
+                self.wants_structured = structured
             else :
-                self.status_vars["text"] = self.to_output
-                callback(self.status_vars)
-                self.status_vars = {"prompt" : self.status_vars["prompt"]}
-                self.to_output = ""
+                self.__send_output(callback, structured)
         else :
             if self.wants_output :
-                self.status_vars["text"] = ""
-                self.wants_output(self.status_vars)
-                self.status_vars = {"prompt" : self.status_vars["prompt"]}
+                self.__send_output(self.wants_output, self.wants_structured)
             self.wants_output = callback
+            self.wants_structured = structured
         self.main_lock.release()
+    def __send_output(self, callback, structured) :
+        """Gives the pending output to the callback and clears it.
+        Assumes main_lock is held."""
+        self.status_vars["text"] = "".join([html for buffer, html in self.to_output])
+        if structured :
+            segments = []
+            for buffer, html in self.to_output :
+                if segments :
+                    segments.append((PARAGRAPH, None, None))
+                segments.extend(buffer)
+            self.status_vars["segments"] = render_json(segments)
+        callback(self.status_vars)
+        self.status_vars = {"prompt" : self.status_vars["prompt"]}
+        self.to_output = []
     def get_input(self, prompt=">") :
         if self.die :
             raise SystemExit("Thread death due to self.die.")
@@ -410,24 +447,34 @@ class TornadoGameIO(object) :
         self.commands.insert(0, input)
         self.main_lock.release()
         self.input_lock.release()
+    @property
+    def discard_output(self) :
+        """Once the client is gone, there is no reason to render
+        anything."""
+        return self.die
     def write(self, *data) :
         self.main_lock.acquire()
-        self.to_flush.extend(data)
+        if not self.die :
+            self.to_flush.extend(data)
         self.main_lock.release()
+    def render_pending(self) :
+        self.main_lock.acquire()
+        try :
+            render_texts(self.to_flush)
+        finally :
+            self.main_lock.release()
     def flush(self) :
+        self.render_pending()
         self.main_lock.acquire()
-        out = " ".join(self.to_flush).replace("[newline]", "</p><p>").replace("[break]", "<br>")
-        out = out.replace("[indent]", "&nbsp;&nbsp;")
-        self.to_output += "<p>"+out+"</p>"
+        buffer = OutputBuffer(self.to_flush)
+        html = render_html(buffer)
+        self.to_output.append((buffer, html))
         self.to_flush = []
         if self.outfile :
-            self.outfile.write("\n\n<p>"+out+"</p>")
+            self.outfile.write("\n\n"+html)
             self.outfile.flush()
         if self.wants_output :
-            self.status_vars["text"] = self.to_output
-            self.wants_output(self.status_vars)
-            self.status_vars = {"prompt" : self.status_vars["prompt"]}
-            self.to_output = ""
+            self.__send_output(self.wants_output, self.wants_structured)
             self.wants_output = None
         self.main_lock.release()
 